@@ -0,0 +1,28 @@
+# DG2000.py
+# Arbitrary waveform upload for the Rigol DG2000 series AWG
+import numpy as np
+from app_base import to_dac_codes
+
+MAX_BLOCK_POINTS = 16384 # largest number of points the AWG accepts in one :trac:data packet
+DAC_MAX = 16383 # DAC16 data is 14 bit, 0 ... 16383, with 8192 at 0 V
+DAC_RANGE = (0, DAC_MAX) # code_range for to_dac_codes, TemplateWF.iter_chunks and CollectionTemplateWF.sample_wf
+
+def _ieee_block(data:bytes)->bytes:
+    '''Definite-length IEEE 488.2 binary block header + data'''
+    n = str(len(data))
+    return f'#{len(n)}{n}'.encode() + data
+
+def send_arb(awg, channel:int, chunks, full_scale:float):
+    '''Stream a waveform to the AWG's volatile memory, one binary packet per chunk.
+    chunks is any iterable of float arrays in volts, e.g. TemplateWF.iter_chunks(sample_rate, MAX_BLOCK_POINTS),
+    so the whole waveform never has to be in memory at once. One chunk is held back so the last packet can be flagged END.'''
+    codes = np.empty(MAX_BLOCK_POINTS, dtype='<u2')
+    pending = None
+    for chunk in chunks:
+        for i in range(0, len(chunk), MAX_BLOCK_POINTS):
+            if pending is not None:
+                awg.write_raw(pending)
+            part = to_dac_codes(chunk[i:i+MAX_BLOCK_POINTS], full_scale, out=codes[:len(chunk[i:i+MAX_BLOCK_POINTS])], code_range=DAC_RANGE)
+            pending = f':sour{channel}:trac:data:dac16 volatile,CON,'.encode() + _ieee_block(part.tobytes()) + b'\n'
+    if pending is not None:
+        awg.write_raw(pending.replace(b',CON,', b',END,', 1))
@@ -3,28 +3,79 @@
 # Adapted from matlab code written by Yueyun Chen
 import pyvisa, time
 import numpy as np
+from collections import defaultdict
 from matplotlib import pyplot as plt
 
-def determine_sample_rate(hscale, memorydepth):
-    # determine the actual sampling rate accroding to the sweep mode
-    return 1e9 # idk what YC's code does here so I'm just returning something
+MAX_MESSAGE_LEN = 1024 # longest ;-joined command string we will send in one write
+latencies:dict[str,list[float]] = defaultdict(list) # ;-joined command headers of a batch -> seconds per round trip, filled by send
+profile_commands = False # if set, send runs every command on its own round trip, so latencies shows the cost of each command
+MAX_READ_POINTS = dict(BYTE=250_000, WORD=125_000) # most points the scope returns for one :wav:data? in RAW mode
+settings_cache:dict[str,dict] = defaultdict(dict) # resource name -> {':acq:mdep': int, ':chan1:disp': bool, ...} as last read back from the scope
+
+# What each scope model can do. Keys of max_sample_rate and memory_depths are channel groups: the active channel count
+# rounded up to 1, 2 or 4, since 3 channels are interleaved like 4. memory_depths are the settable :acq:mdep values, in points.
+SCOPE_CAPS = dict(
+    DHO1074 = dict(max_sample_rate = {1:2e9, 2:1e9, 4:5e8}, # Sa/s
+                   memory_depths = {1:(1e3, 1e4, 1e5, 1e6, 1e7, 25e6, 50e6),
+                                    2:(1e3, 1e4, 1e5, 1e6, 1e7, 25e6),
+                                    4:(1e3, 1e4, 1e5, 1e6, 1e7)},
+                   divisions = 10), # horizontal divisions on screen
+)
+SCOPE_CAPS['DHO1204'] = SCOPE_CAPS['DHO1104'] = SCOPE_CAPS['DHO1074'] # same acquisition system, different front ends
+HSCALE_STEPS = (1, 2, 5) # s/div settings go 1-2-5 in every decade
+
+def channel_group(n_channels:int)->int:
+    assert 1 <= n_channels <= 4, f'Expected 1 to 4 active channels, got {n_channels}'
+    return 1 if n_channels == 1 else (2 if n_channels == 2 else 4)
+
+def determine_sample_rate(hscale, memorydepth, n_channels:int=1, model:str='DHO1074', oscope=None)->float:
+    '''Actual sample rate (Sa/s) for a horizontal scale (s/div), memory depth and number of active channels.
+    The scope fills the memory over the screen width unless that would exceed its maximum rate.
+    If oscope is given, the settings are assumed to be applied already and the rate is read back with :acq:srat? instead.'''
+    if oscope is not None:
+        return float(oscope.query(':acq:srat?'))
+    caps = SCOPE_CAPS[model]
+    return min(caps['max_sample_rate'][channel_group(n_channels)], memorydepth/(caps['divisions']*hscale))
+
+def _hscale_at_least(hscale:float)->float:
+    '''Smallest 1-2-5 horizontal scale that is at least hscale'''
+    decade = 10**np.floor(np.log10(hscale))
+    for step in HSCALE_STEPS + (10,):
+        if step*decade >= hscale*(1-1e-9):
+            return float(f'{step*decade:.3g}') # 2e-07, not 2.0000000000000002e-07
+
+def plan_acquisition(duration:float, sample_rate:float, n_channels:int=1, model:str='DHO1074')->dict:
+    '''Smallest memory depth, and the horizontal scale to go with it, that records duration seconds at sample_rate or faster.
+    E.g. duration = CollectionTemplateWF.duration(). If the scope can not sample that fast, the fastest possible rate is used.
+    Returns dict(hscale, memorydepth, sample_rate) with the sample rate the scope will really use.'''
+    assert duration > 0, 'Nothing to record'
+    caps = SCOPE_CAPS[model]
+    hscale = _hscale_at_least(duration/caps['divisions'])
+    depths = caps['memory_depths'][channel_group(n_channels)]
+    for memorydepth in depths: # ascending, so the first that is fast enough is the smallest
+        fs = determine_sample_rate(hscale, memorydepth, n_channels, model)
+        if fs >= sample_rate*(1-1e-9) or fs >= caps['max_sample_rate'][channel_group(n_channels)]:
+            break
+    return dict(hscale=float(hscale), memorydepth=int(memorydepth), sample_rate=float(fs))
 
 def identify(oscope):
     return oscope.query('*IDN?')
 
 def reset(oscope):
     cmds = ['*RST']
-    cmds.extend([f':chan{i}:disp 0' for i in range(4)]) # turn off all channels. *RST might do this?
+    cmds.extend([f':chan{i}:disp 0' for i in range(1,5)]) # turn off all channels. *RST might do this?
     send(oscope, cmds)
 
 def hconfig(oscope, hscale, memorydepth=10e6, trigoffset=0):
-    '''All channels share horizontal configuration'''
+    '''All channels share horizontal configuration. Configure the channels (vconfig) first, the sample rate depends on how many are on.'''
     cmds = []
     cmds.append(":tim:roll 0") # turn off roll mode to enable trigger for time scale greater than 50 ms/div
     cmds.append(f":tim:main:scal {hscale}") # set time scale, s/div
     cmds.append(f":acq:mdep {memorydepth}") # set memory depth, Sa
+    send(oscope, cmds)
 
-    fs = determine_sample_rate(hscale, memorydepth) # determine the actual sampling rate, Sa/s
+    fs = determine_sample_rate(hscale, memorydepth, oscope=oscope) # the actual sampling rate, Sa/s, read back now that it is set
+    cmds = []
 
     # make sure trigger position doesn't fall into 0-1% of horizontal scale (s/div) in slow sweep mode
     # as of 2024/12/19, that will cause the oscilloscope to not trigger due to firmware bug
@@ -53,68 +104,148 @@ def vconfig(oscope,channel:int, vscale, voffset, triglvl=0.5, trigsrc='EXT'):
 
     send(oscope,cmds)
 
-def send(oscope,cmds):
-    # send all the commands
+def _join(cmds, max_len=MAX_MESSAGE_LEN):
+    '''Group commands into ;-separated program messages no longer than max_len'''
+    batch = []
+    for cmd in cmds:
+        if batch and len(';'.join(batch + [cmd])) > max_len:
+            yield batch
+            batch = []
+        batch.append(cmd)
+    if batch:
+        yield batch
+
+def _settings(oscope)->dict:
+    return settings_cache[getattr(oscope, 'resource_name', str(id(oscope)))]
+
+def _track_settings(oscope, cmds):
+    '''Forget cached settings that these commands change, so the next get_data reads them back once'''
+    cache = _settings(oscope)
     for cmd in cmds:
-        oscope.write(cmd) # 1 s delay might be necessary for the oscilloscope to be ready for recieving trigger
-        time.sleep(0.2)
+        header = cmd.split()[0].lower()
+        if header in ('*rst', '*rcl'):
+            cache.clear()
+        else:
+            cache.pop(header, None)
+
+def invalidate_settings(oscope):
+    '''Call this if settings may have been changed behind our back, e.g. from the front panel'''
+    _settings(oscope).clear()
+
+def read_settings(oscope, headers:list[str])->dict:
+    '''Values of the given settings (e.g. ':acq:mdep'), queried in a single round trip for any that are not cached'''
+    cache = _settings(oscope)
+    missing = [h for h in headers if h not in cache]
+    if len(missing) > 0:
+        res = oscope.query(';'.join(h + '?' for h in missing)).strip().split(';')
+        assert len(res) == len(missing), f'Expected {len(missing)} responses to {missing}, but got {res}'
+        cache.update(zip(missing, (r.strip() for r in res)))
+    return {h:cache[h] for h in headers}
+
+def parse_preamble(pre:str)->dict:
+    '''Parse the :wav:pre? response: format, type, points, count, xinc, xor, xref, yinc, yor, yref'''
+    fields = pre.strip().split(',')
+    assert len(fields) == 10, f'Unexpected waveform preamble {pre}'
+    x_increment, x_origin, x_reference, y_increment, y_origin, y_reference = map(float, fields[4:])
+    return dict(points=int(float(fields[2])),
+                x_increment=x_increment, # s
+                x_offset=x_origin - x_reference*x_increment, # s. Time of the first point related to the trigger position
+                y_increment=y_increment, # V/ADU
+                y_reference=y_reference, # ADU, where the middle level is
+                y_origin=y_origin, # ADU, relative to the middle level
+                y_offset=-(y_reference+y_origin)*y_increment) # V, so that volts = raw*y_increment + y_offset
+
+def send(oscope,cmds):
+    '''Send commands joined with ; in as few writes as possible. The last write ends in *OPC?, so this returns
+    as soon as the scope has finished executing them, instead of sleeping a fixed time per command.
+    The round trip of each call is recorded in latencies, per command if profile_commands is set.'''
+    cmds = list(cmds)
+    if len(cmds) == 0:
+        return
+    _track_settings(oscope, cmds)
+    if profile_commands: # one command per round trip, slower but shows which command is slow
+        for cmd in cmds:
+            t0 = time.perf_counter()
+            oscope.query(f'{cmd};*OPC?')
+            latencies[cmd.split()[0].lower()].append(time.perf_counter() - t0)
+        return
+    t0 = time.perf_counter()
+    batches = list(_join(cmds))
+    for batch in batches[:-1]:
+        oscope.write(';'.join(batch))
+    oscope.query(';'.join(batches[-1] + ['*OPC?'])) # blocks until every command above is done
+    latencies[';'.join(cmd.split()[0].lower() for cmd in cmds)].append(time.perf_counter() - t0)
+
+def latency_report()->str:
+    '''Table of the latencies recorded by send: per batch of commands, or per command if profile_commands was set'''
+    width = max([20] + [len(cmd) for cmd in latencies])
+    lines = [f'{"command":<{width}} {"n":>5} {"mean (ms)":>10} {"max (ms)":>10}']
+    for cmd, ts in sorted(latencies.items()):
+        lines.append(f'{cmd:<{width}} {len(ts):>5} {np.mean(ts)*1e3:>10.2f} {np.max(ts)*1e3:>10.2f}')
+    return '\n'.join(lines)
+
+def wait_for_status(oscope, states:tuple[str], timeout:float=3, interval:float=0.01)->str:
+    '''Poll :trig:stat? until it reports one of states, or timeout seconds pass. Returns the last status.'''
+    t_end = time.perf_counter() + timeout
+    while True:
+        res = oscope.query(":trig:stat?").strip().upper()
+        if any(state in res for state in states) or time.perf_counter() > t_end:
+            return res
+        time.sleep(interval)
 
 def force_trigger(oscope):
     # send software trigger and wait for acquisition to finish
-    hscale = oscope.query(":tim:main:scal?") # query the horizontal scale, seconds
-    time.sleep(1)
+    wait_for_status(oscope, ('WAIT', 'STOP'), timeout=1) # make sure :single has armed the scope
     oscope.write(":tforce") # send software trigger, no OPC query
 
-def get_data(oscope, timeout=3):
-    res = oscope.query(":trig:stat?")
-    print(res)
-    if 'STOP' not in res: # check if acquisition finished
-        print(f"Acquisition not finished, data transfer will time out in {timeout} sec!")
-        time.sleep(timeout)
-        
-        res = oscope.query(":trig:stat?")
-        print(res)
-        
-        if 'STOP' not in res: # check if acquisition finished
-            print("Data transfer not started due to incomplete acquisition!")
-            return
-        else:
-            print("Acquisition finished, proceed to data transfer!")
+def read_waveform(oscope, pts:int, fmt:str='WORD', out:np.ndarray|None=None, chunk_points:int|None=None)->np.ndarray:
+    '''Read pts points of the current :wav:sour, at most chunk_points per :wav:data? (default MAX_READ_POINTS[fmt]).
+    Each block is decoded as an ndarray view of the received bytes and copied straight into its slice of out,
+    which is a preallocated uint16 buffer (BYTE data is widened in the same copy). No python lists are built.'''
+    if out is None:
+        out = np.empty(pts, dtype=np.uint16)
+    chunk = chunk_points or MAX_READ_POINTS[fmt]
+    datatype = 'B' if fmt == 'BYTE' else 'H'
+    for start in range(0, pts, chunk):
+        stop = min(start+chunk, pts)
+        # the window must never be empty (start > stop) after any single command. Points are indexed from 1.
+        if start == 0: # moving back to the beginning, from wherever the last read left the window: start first
+            oscope.write(f':wav:start 1;:wav:stop {stop};:wav:data?')
+        else: # moving forward: stop first
+            oscope.write(f':wav:stop {stop};:wav:start {start+1};:wav:data?')
+        out[start:stop] = oscope.read_binary_values(datatype=datatype, container=np.ndarray, data_points=stop-start)
+    return out
+
+def get_data(oscope, timeout=3, bits:int=12):
+    '''Read every active channel. bits is the acquisition resolution, 8 bits or less is transferred as BYTE, otherwise WORD.'''
+    res = wait_for_status(oscope, ('STOP',), timeout=timeout) # check if acquisition finished
+    if 'STOP' not in res:
+        print("Data transfer not started due to incomplete acquisition!")
+        return
     
-    # read memory depth
-    pts = int(float(oscope.query(":acq:mdep?").strip()))
-
-    # determine active vertical channels
-    active_ch = []
-    for ch in range(1,5): # channels are indexed from 1, not 0
-        if '1' in oscope.query(f":chan{ch}:disp?"):
-            active_ch.append(ch)
+    # memory depth and active vertical channels, read back only if they changed since the last acquisition
+    settings = read_settings(oscope, [':acq:mdep'] + [f':chan{ch}:disp' for ch in range(1,5)]) # channels are indexed from 1, not 0
+    pts = int(float(settings[':acq:mdep']))
+    active_ch = [ch for ch in range(1,5) if '1' in settings[f':chan{ch}:disp']]
     assert len(active_ch) > 0, 'No channels are being read!'
 
     # initialize waveform buffer and waveform info table
-    # wf_buffer = np.zeros((len(active_ch),pts), dtype=np.uint16)
+    wf_buffer = np.empty((len(active_ch),pts), dtype=np.uint16)
     wf_info = {ch:dict(samples=pts) for ch in active_ch}
+    fmt = 'BYTE' if bits <= 8 else 'WORD' # waveform data as byte (8-bit) or word (16-bit)
 
     # read active channel's vertical information
     for i,ch in enumerate(active_ch):
         cmds = [] # initialize command array
         cmds.append(f":wav:sour CHAN{ch}") # source channel
         cmds.append(":wav:mode RAW") # read data from memory
-        cmds.append(":wav:form WORD") # set waveform data to word (16-bit), or byte (8-bit)
+        cmds.append(f":wav:form {fmt}") # set waveform data to word (16-bit), or byte (8-bit)
+        cmds.append(":wav:start 1") # start first, the previous channel's read left start near the end of memory
         cmds.append(f":wav:stop {pts}") # set data reading stop point
-        send(oscope, cmds)
-
-        wf_info[ch]['raw_data'] = np.array(oscope.query_binary_values(":wav:data?", datatype='H'), dtype=np.uint16) # read data, no OPC command. H means unsigned short (16 bits)
+        # setup and the whole preamble (x and y scaling) in one round trip
+        wf_info[ch].update( parse_preamble(oscope.query(';'.join(cmds + [':wav:pre?']))) )
 
-        wf_info[ch]['y_increment'] = float(oscope.query(":wav:yinc?").strip()) # read y-increment, V/ADU
-        wf_info[ch]['y_reference'] = float(oscope.query(":wav:yref?").strip()) # read y-reference, ADU, where the middle level is
-        wf_info[ch]['y_origin'] = float(oscope.query(":wav:yor?").strip()) # # read y-origin, ADU, relative to the middle level
-        print(wf_info[ch]['y_increment'], wf_info[ch]['y_reference'], wf_info[ch]['y_origin'], type(wf_info[ch]['y_origin']))
-        wf_info[ch]['y_offset'] = (wf_info[ch]['y_reference']+wf_info[ch]['y_origin'])*wf_info[ch]['y_increment'] # y-offset, V
-        
-        # read horizontal information (xinc,xor), not channel-specific but I will save it that way anyway because it will make life easier
-        wf_info[ch]['x_increment'] = float(oscope.query(":wav:xinc?").strip()) # read x-increment, s
-        wf_info[ch]['x_offset'] =    float(oscope.query(":wav:xor?" ).strip()) # read x-offset, s. Time of the first point related to the trigger position            
+        wf_info[ch]['raw_data'] = read_waveform(oscope, pts, fmt, out=wf_buffer[i]) # read data in blocks, no OPC command
 
     return wf_info
 
@@ -125,6 +256,7 @@ def wf_data_to_volts(raw_data, x_increment, x_offset, y_increment, y_offset, **u
 
 
 if __name__ == '__main__':
+    profile_commands = True # time each command on its own for latency_report
     rm = pyvisa.ResourceManager()
 
     with rm.open_resource('TCPIP0::10.97.108.205::INSTR') as oscope:
@@ -139,6 +271,7 @@ if __name__ == '__main__':
         force_trigger(oscope)
 
         wf_info = get_data(oscope)
+        print(latency_report())
 
         for ch, wf_data in wf_info.items():
             plt.plot(*wf_data_to_volts(**wf_data), label=f'ch{ch}')
@@ -0,0 +1,95 @@
+# acquisition.py
+# Arm, trigger and read out several instruments at once.
+# Every instrument gets its own lock, so one instrument only ever runs one operation at a time, while different instruments
+# run concurrently in a thread pool. pyvisa releases the GIL while waiting on I/O, so threads are enough here.
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import pyvisa
+import DHO1000_test
+from jobs import os_lock
+
+# OS thread locks (see jobs.py), since GUI jobs and greenlets share these with acquisition threads
+_locks_lock = os_lock()
+instrument_locks:dict[str,object] = defaultdict(lambda: os_lock(reentrant=True)) # resource name -> lock held while talking to that instrument
+
+def resource_lock(resource_name:str):
+    '''The lock for the instrument at resource_name, see instrument_lock'''
+    with _locks_lock:
+        return instrument_locks[resource_name]
+
+def instrument_lock(inst):
+    '''The lock for one instrument. Hold it around any sequence of commands that must not be interleaved with another thread's.'''
+    return resource_lock(getattr(inst, 'resource_name', str(id(inst))))
+
+def locked_call(inst, func, *args, **kwargs):
+    '''func(inst, *args, **kwargs) while holding inst's lock'''
+    with instrument_lock(inst):
+        return func(inst, *args, **kwargs)
+
+def run_parallel(instruments:list, func, *args, pool:ThreadPoolExecutor|None=None, **kwargs)->list:
+    '''func(inst, *args, **kwargs) for every instrument at the same time, each under its own lock.
+    Returns the results in the order of instruments and re-raises the first exception, after all calls have finished.'''
+    own_pool = pool is None
+    if own_pool:
+        pool = ThreadPoolExecutor(max_workers=max(len(instruments), 1))
+    try:
+        futures = [pool.submit(locked_call, inst, func, *args, **kwargs) for inst in instruments]
+        errors = [f.exception() for f in futures]
+        for e in errors:
+            if e is not None:
+                raise e
+        return [f.result() for f in futures]
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+def arm(oscope):
+    '''Stop and start a single acquisition, returning once the scope has taken the commands'''
+    DHO1000_test.send(oscope, [':stop', ':single'])
+
+def trigger_and_read(oscope, timeout:float=3, bits:int=12)->dict:
+    '''Software trigger one armed scope and read back all of its active channels'''
+    DHO1000_test.force_trigger(oscope)
+    return DHO1000_test.get_data(oscope, timeout=timeout, bits=bits)
+
+def acquire(scopes:list, timeout:float=3, bits:int=12, pool:ThreadPoolExecutor|None=None)->list[dict]:
+    '''One capture from every scope: all are armed, triggered and read out in parallel.
+    Takes about as long as the slowest scope, rather than the sum of all of them. Returns one get_data result per scope.'''
+    run_parallel(scopes, arm, pool=pool)
+    return run_parallel(scopes, trigger_and_read, timeout=timeout, bits=bits, pool=pool)
+
+def acquire_pipelined(scopes:list, n_captures:int, analyze, timeout:float=3, bits:int=12):
+    '''Take n_captures captures from all scopes, yielding analyze(captures) for each, where captures is the list from acquire.
+    The next capture is read out in the background while the previous one is analyzed, so a cycle takes
+    about max(acquisition, analysis) instead of their sum. Captures are freshly allocated, so analysis may keep them.'''
+    with ThreadPoolExecutor(max_workers=len(scopes)+1) as pool:
+        acquirer = ThreadPoolExecutor(max_workers=1) # acquire() itself waits on the pool, so it runs on a separate thread
+        try:
+            pending = acquirer.submit(acquire, scopes, timeout, bits, pool) if n_captures > 0 else None
+            for i in range(n_captures):
+                captures = pending.result()
+                pending = acquirer.submit(acquire, scopes, timeout, bits, pool) if i+1 < n_captures else None
+                yield analyze(captures)
+        finally:
+            if pending is not None:
+                pending.cancel()
+            acquirer.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    import time
+    rm = pyvisa.ResourceManager()
+    scopes = [rm.open_resource(f'TCPIP0::10.97.108.{ip}::INSTR') for ip in (205, 206)]
+    try:
+        run_parallel(scopes, DHO1000_test.reset)
+        for oscope in scopes:
+            for ch in (1,2):
+                DHO1000_test.vconfig(oscope, channel=ch, vscale=0.1, voffset=0)
+        run_parallel(scopes, DHO1000_test.hconfig, hscale=1e-6, memorydepth=10e6)
+
+        t0 = time.perf_counter()
+        for i, means in enumerate(acquire_pipelined(scopes, 5, lambda caps: [{ch:info['raw_data'].mean() for ch,info in cap.items()} for cap in caps])):
+            print(f'capture {i} at {time.perf_counter()-t0:.2f} s: {means}')
+    finally:
+        for oscope in scopes:
+            oscope.close()
@@ -1,8 +1,27 @@
-import numpy as np # only for typehinting
+import weakref
+import numpy as np
+from collections import OrderedDict
+from functools import wraps
+from jobs import os_lock
+
+
+def cached_selector(func):
+    '''Decorator turning a selector method into a property whose value is kept until _invalidate_selector clears it.
+    Selectors are built from the parent's selector, so anything that moves an element must invalidate its whole subtree.'''
+    @wraps(func)
+    def getter(self):
+        if self._selector_cache is None:
+            self._selector_cache = func(self)
+        return self._selector_cache
+    return property(getter)
 
 
 class _Base:
     py_id_counter = 0
+    class_registry:dict[str,type] = {} # class name -> class, for every subclass of _Base. Filled as classes are defined.
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _Base.class_registry[cls.__name__] = cls
     @classmethod
     def _get_all_subclasses(cls):
         '''Recursively get all subclasses of this class. This list includes this class.'''
@@ -14,24 +33,35 @@ class _Base:
     def from_dict(d:dict):
         '''Recursively load a state'''
         _type = d.pop('_type')
-        for cls in _Base._get_all_subclasses():
-            if cls.__name__ == _type:
-                this = cls(**d)
-                return this
-        else:
+        py_id = d.pop('py_id', None)
+        if _type not in _Base.class_registry:
             raise ValueError(f'{_type} is not a valid subclass of _Base!')
+        this = _Base.class_registry[_type](**d)
+        if py_id is not None: # keep ids stable across save/load, the frontend refers to elements by them
+            this._set_py_id(int(py_id))
+        return this
     def to_dict(self)->dict:
         return dict(_type=self.__class__.__name__,
                     py_id=self.py_id)
     def __init__(self):
         self.parent = None
         self.py_id = _Base.py_id_counter
+        self._selector_cache:str|None = None
         _Base.py_id_counter += 1
+    def _set_py_id(self, py_id:int):
+        self.py_id = py_id
+        _Base.py_id_counter = max(_Base.py_id_counter, py_id+1)
     def update(self, **params):
         for k,e in params.items():
             setattr(self, k, float(e))
+        self._invalidate_selector() # e.g. channel is part of some selectors
     def apply(self, func):
         func(self)
+    def _invalidate_selector(self):
+        '''Forget the cached selectors of this element and everything below it'''
+        def clear(e):
+            e._selector_cache = None
+        self.apply(clear)
     def find_by_py_id(self, id):
         if self.py_id == id:
             return self
@@ -57,60 +87,291 @@ class _BaseParent(_Base):
     def __init__(self):
         super().__init__()
         self._children:list[_Base, _BaseParent] = []
+        self._registry = weakref.WeakValueDictionary({self.py_id: self}) # py_id -> element, for the whole tree. Only the root's is kept up to date.
+        self._positions:dict[int,int]|None = None # id(child) -> index in _children, rebuilt lazily after the children change
     def apply(self, func):
         '''Apply func to every element in the tree lower than this element, including this element'''
         for child in self._children:
                 child.apply(func)
         super().apply(func)
+    def _set_py_id(self, py_id:int):
+        self._root()._registry.pop(self.py_id, None)
+        super()._set_py_id(py_id)
+        self._register(self)
+    def _root(self)->'_BaseParent':
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        return root
+    def _register(self, elem:_Base):
+        '''Add elem and everything below it to the root's registry'''
+        registry = self._root()._registry
+        def add(e):
+            registry[e.py_id] = e
+        elem.apply(add)
+    def _unregister(self, elem:_Base):
+        '''Remove elem and everything below it from the root's registry. elem is detached and becomes the root of its own registry.'''
+        registry = self._root()._registry
+        def remove(e):
+            registry.pop(e.py_id, None)
+        elem.apply(remove)
+        elem.parent = None
+        if isinstance(elem, _BaseParent):
+            elem._registry = weakref.WeakValueDictionary()
+            elem._register(elem)
+    def index_of(self, child:_Base)->int:
+        '''Position of child in this element's children, without a linear search'''
+        if self._positions is None:
+            self._positions = {id(c):i for i,c in enumerate(self._children)}
+        return self._positions[id(child)]
     def find_by_py_id(self, id):
-        for child in self._children:
-            if child.py_id == id:
-                return child
-            else:
-                res = child.find_by_py_id(id)
-                if res is not None:
-                    return res
-        return super().find_by_py_id(id)
+        '''Constant time lookup through the root's registry, restricted to the tree below (and including) this element'''
+        elem = self._root()._registry.get(id)
+        node = elem
+        while node is not None and node is not self:
+            node = node.parent
+        return elem if node is self else None
     def add_child(self, child):
         assert any([isinstance(child, cls) for cls in _Base.__subclasses__()]), f'Child ({type(child)}) must be an instance of a subclass of _Base, e.g. {_Base.__subclasses__()}'
         self._children.append(child)
         child.parent = self
+        self._register(child)
+        self._positions = None
+        child._invalidate_selector()
     def pop(self, idx:int):
-        return self._children.pop(idx)
+        child = self._children.pop(idx)
+        self._unregister(child)
+        self._positions = None
+        child._invalidate_selector()
+        for sibling in self._children[idx if idx >= 0 else len(self._children)+idx+1:]: # everything after it moved up one place
+            sibling._invalidate_selector()
+        return child
     def __getitem__(self, idx:int):
         assert isinstance(idx, int), f'List_WF_Block only supports integer indexing right now. No slicing.'
         return self._children[idx]
     def __setitem__(self, idx:int, child):
         assert isinstance(idx, int), f'List_WF_Block only supports integer indexing right now. No slicing.'
         # assert isinstance(child, AppState), f'Expected WF_Block_Base, but got {type(child)} which does not inherit from Abstrack_WF_Block!'
+        old = self._children[idx]
         self._children[idx] = child
+        if old is not child and not any(c is old for c in self._children): # e.g. swap_children puts it back at another index
+            self._unregister(old)
+        child.parent = self
+        self._register(child)
+        self._positions = None
+        old._invalidate_selector()
+        child._invalidate_selector()
     def swap_children(self, idx1:int, idx2:int):
         self[idx1], self[idx2] = self[idx2], self[idx1]
 
 
+class SampleCache:
+    '''LRU cache of sampled waveform arrays, bounded by a total byte budget.
+    Entries are keyed by (block class, parameter tuple, method name, sample rate), so identical blocks share entries
+    and a block whose parameters change simply stops hitting its old entries.
+    Shared by job threads, sweep threads and GUI greenlets, so every access to the entries holds an OS thread lock.'''
+    def __init__(self, max_bytes:int=512*2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries:OrderedDict[tuple, np.ndarray] = OrderedDict()
+        self._lock = os_lock()
+    def peek(self, key:tuple)->np.ndarray|None:
+        '''Like get, but does not count towards the hit/miss statistics or the LRU order'''
+        with self._lock:
+            return self._entries.get(key)
+    def get(self, key:tuple)->np.ndarray|None:
+        with self._lock:
+            arr = self._entries.get(key)
+            if arr is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return arr
+    def put(self, key:tuple, arr:np.ndarray)->np.ndarray:
+        arr.setflags(write=False) # shared between callers, nobody gets to modify it in place
+        if arr.nbytes > self.max_bytes: # would evict everything else and still not fit
+            return arr
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key).nbytes
+            self._entries[key] = arr
+            self.nbytes += arr.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self.nbytes -= old.nbytes
+        return arr
+    def invalidate(self, block_key:tuple):
+        '''Drop every entry (any method, any sample rate) belonging to blocks with this (class, params) key'''
+        with self._lock:
+            for key in [key for key in self._entries if key[:2] == block_key]:
+                self.nbytes -= self._entries.pop(key).nbytes
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+sample_cache = SampleCache()
+
+def cached_sampling(method):
+    '''Decorator for TemplateWF methods of the form method(self, sample_rate)->np.ndarray.
+    Results are memoized in sample_cache. Returned arrays are read-only.'''
+    @wraps(method)
+    def wrapper(self, sample_rate:float):
+        key = self._cache_key() + (method.__name__, float(sample_rate))
+        arr = sample_cache.get(key)
+        if arr is None:
+            arr = sample_cache.put(key, np.asarray(method(self, sample_rate)))
+        return arr
+    return wrapper
+
+def to_dac_codes(v:np.ndarray, full_scale:float, out:np.ndarray, chunk:int=2**20, code_range:tuple[int,int]|None=None)->np.ndarray:
+    '''Convert volts to integer DAC codes in out, so that -full_scale ... +full_scale maps onto code_range (lowest, highest code),
+    e.g. DG2000.DAC_RANGE. The default is symmetric around code 0, with +full_scale at the largest code of out.dtype.
+    Works through v in chunks so the float temporaries stay small.'''
+    if code_range is None:
+        code_range = (-np.iinfo(out.dtype).max, np.iinfo(out.dtype).max)
+    lo, hi = code_range
+    assert np.iinfo(out.dtype).min <= lo < hi <= np.iinfo(out.dtype).max, f'Codes {code_range} do not fit in {out.dtype}'
+    scale, mid = (hi-lo)/2/full_scale, (hi+lo)/2
+    buf = np.empty(min(chunk, len(v)))
+    for i in range(0, len(v), chunk):
+        b = buf[:len(v[i:i+chunk])]
+        np.multiply(v[i:i+chunk], scale, out=b)
+        b += mid
+        np.rint(b, out=b)
+        np.clip(b, lo, hi, out=b)
+        out[i:i+len(b)] = b
+    return out
+
+
 class TemplateWF(_Base):
     '''Abstract base class instructions.'''
+    tile_periods = True # render periodic blocks one period at a time and tile it. Clear sample_cache after changing this.
+    def _cache_key(self)->tuple:
+        '''(class, parameter tuple) identifying what this block samples to. Blocks holding arrays should override this.'''
+        return (self.__class__, tuple((k,e) for k,e in self.to_dict().items() if k not in ('_type', 'py_id', 'children')))
+    def update(self, **params):
+        sample_cache.invalidate(self._cache_key())
+        super().update(**params)
     def get_skeleton(self)->tuple[np.ndarray, np.ndarray]:
         raise NotImplementedError
     def get_time_array(self, sample_rate:float)->np.ndarray:
         '''Get an array of times corresponding to this block, for the specified sample rate'''
         raise NotImplementedError
+    def n_samples(self, sample_rate:float)->int:
+        '''Number of samples in this block at the specified sample rate'''
+        return len(self.get_time_array(sample_rate))
+    @cached_sampling
     def sample_wf(self, sample_rate:float)->np.ndarray:
         '''Get an array of values corresponding to this block, for the specified sample rate'''
+        out = np.empty(self.n_samples(sample_rate))
+        self._fill(out, sample_rate)
+        return out
+    def sample_into(self, out:np.ndarray, sample_rate:float, start:int=0):
+        '''Write samples start ... start+len(out) of this block into out.
+        Reuses a cached sample_wf result if there is one. If out is the whole block, it is rendered through sample_wf so the
+        next call (e.g. after an edit to another block of a collection) hits the cache. A part of a block is rendered straight
+        into out without allocating the block.'''
+        key = self._cache_key() + ('sample_wf', float(sample_rate))
+        cached = sample_cache.peek(key)
+        if cached is None and start == 0 and len(out) == self.n_samples(sample_rate) and out.nbytes <= sample_cache.max_bytes:
+            cached = self.sample_wf(sample_rate)
+        if cached is not None:
+            out[...] = cached[start:start+len(out)]
+        else:
+            self._fill(out, sample_rate, start)
+    def _fill(self, out:np.ndarray, sample_rate:float, start:int=0):
+        '''Render samples start ... start+len(out) into out, by tiling one period if the block is periodic at this rate'''
+        P = self.samples_per_period(sample_rate) if self.tile_periods else None
+        if P is None:
+            self._render_into(out, sample_rate, start)
+            return
+        period = self._period_wf(sample_rate)
+        whole = (self.n_samples(sample_rate)//P)*P # samples covered by complete periods
+        i, g = 0, start # local and global sample index
+        if g < whole and g % P: # finish the period we start in
+            m = min(P - g%P, len(out), whole-g)
+            out[:m] = period[g%P:g%P+m]
+            i, g = m, g+m
+        q = min(len(out)-i, max(whole-g, 0))//P
+        if q > 0: # bulk of whole periods in a single broadcast copy
+            out[i:i+q*P].reshape(q, P)[...] = period
+            i, g = i+q*P, g+q*P
+        m = min(len(out)-i, max(whole-g, 0))
+        out[i:i+m] = period[:m]
+        i, g = i+m, g+m
+        if i < len(out): # whatever is left after the last whole period is rendered directly
+            self._render_into(out[i:], sample_rate, g)
+    def period(self)->float|None:
+        '''Repetition period of this block in seconds, or None if it does not repeat'''
+        return None
+    def samples_per_period(self, sample_rate:float)->int|None:
+        '''Samples in one period, if the period is a whole number of samples and the block holds at least two of them. Otherwise None.'''
+        T = self.period()
+        if T is None or T <= 0:
+            return None
+        x = T*sample_rate
+        P = int(round(x))
+        if P < 1 or abs(x-P) > 1e-6 or self.n_samples(sample_rate) < 2*P:
+            return None
+        return P
+    @cached_sampling
+    def _period_wf(self, sample_rate:float)->np.ndarray:
+        out = np.empty(self.samples_per_period(sample_rate))
+        self._render_into(out, sample_rate)
+        return out
+    def sample_periodic(self, sample_rate:float)->tuple[np.ndarray, int, np.ndarray]:
+        '''(one period, number of repeats, tail) for AWGs with sequence memory: upload the period once with a repeat count,
+        then the tail. Blocks that are not periodic at this rate come back as a single repeat of the whole block with no tail.'''
+        P = self.samples_per_period(sample_rate)
+        if P is None:
+            return self.sample_wf(sample_rate), 1, np.empty(0)
+        n = self.n_samples(sample_rate)
+        tail = np.empty(n % P)
+        self._render_into(tail, sample_rate, n - n%P)
+        return self._period_wf(sample_rate), n//P, tail
+    def tiled_view(self, sample_rate:float)->np.ndarray:
+        '''The whole periods of this block as a read-only (repeats, samples_per_period) view of a single period. Nothing is copied.'''
+        period, repeats, _ = self.sample_periodic(sample_rate)
+        return np.lib.stride_tricks.as_strided(period, shape=(repeats, len(period)), strides=(0, period.strides[0]), writeable=False)
+    def _render_into(self, out:np.ndarray, sample_rate:float, start:int=0):
+        '''Compute samples start ... start+len(out) of this block into the floating point array out.
+        The result must not depend on how the block is split up, so that chunks line up exactly.'''
         raise NotImplementedError
+    def iter_chunks(self, sample_rate:float, chunk_size:int=2**20, dtype:np.dtype=float, full_scale:float|None=None,
+                    code_range:tuple[int,int]|None=None):
+        '''Yield the sampled waveform in consecutive chunks of chunk_size samples (the last one may be shorter).
+        The same buffer is reused for every chunk, so memory use does not grow with the waveform length;
+        copy a chunk if you need to keep it. Integer dtypes give DAC codes, see to_dac_codes.'''
+        n = self.n_samples(sample_rate)
+        dtype = np.dtype(dtype)
+        floating = np.issubdtype(dtype, np.floating)
+        assert floating or full_scale is not None, f'full_scale must be given to sample into integer dtype {dtype}'
+        buf = np.empty(min(chunk_size, n), dtype=dtype if floating else float)
+        codes = None if floating else np.empty(len(buf), dtype=dtype)
+        for start in range(0, n, chunk_size):
+            b = buf[:min(chunk_size, n-start)]
+            self.sample_into(b, sample_rate, start)
+            if floating:
+                yield b
+            else:
+                yield to_dac_codes(b, full_scale, out=codes[:len(b)], code_range=code_range)
     def get_ROIs(self, sample_rate:float, offset:float=0, lblfmt:str='{prefix}.{suffix}')->dict[str,slice]:
         '''Get slices that correspond to ROIs of this waveform'''
         return {}
-    @property
+    @cached_selector
     def selector(self): # Here I am assuming that these elements are directly inside of the parent element
-        i = self.parent._children.index(self)
+        i = self.parent.index_of(self)
         return (self.parent.selector if self.parent is not None else '') + f' [data-pyclassname]:nth-child({i+1})'
 
 class _DeviceSettings(_BaseParent):
     def add_child(self, child):
         assert child.channel not in [child_.channel for child_ in self._children], f'A child representing this channel ({child.channel}) already exists!'
         return super().add_child(child)
-    @property
+    @cached_selector
     def selector(self):
         return (self.parent.selector + ' ' if self.parent is not None else '') + f'[data-pyclassname="{self.__class__.__name__}"]'
 
@@ -129,7 +390,7 @@ class AWGChannelSettings(_BaseParent):
         self.sample_rate = sample_rate
     def add_child(self, child):
         return super().add_child(child)
-    @property
+    @cached_selector
     def selector(self):
         return (self.parent.selector + ' ' if self.parent is not None else '') + f'[data-pyclassname="{self.__class__.__name__}"][data-channel="{self.channel}"]'
 class AWGSettings(_DeviceSettings):
@@ -162,7 +423,7 @@ class OscilloscopeChannelSettings(_Base):
             self.transimpedance = transimpedance
         else:
             self.transimpedance = None
-    @property
+    @cached_selector
     def selector(self):
         return (self.parent.selector + ' ' if self.parent is not None else '') + f'[data-pyclassname="{self.__class__.__name__}"][data-channel="{self.channel}"]'
 class OscilloscopeSettings(_DeviceSettings):
@@ -210,7 +471,7 @@ class Tab(_BaseParent):
         assert child.__class__.__name__ not in [child_.__class__.__name__ for child_ in self._children], f'Tab already holds one of {child.__class__.__name__}!'
         assert isinstance(child, _DeviceSettings), f'Tab children should be any of: {_DeviceSettings._get_all_subclasses()}'
         return super().add_child(child)
-    @property
+    @cached_selector
     def selector(self):
         return (self.parent.selector if self.parent is not None else '') + f'#{self.id}' + ' '
 
@@ -229,7 +490,7 @@ class AppState(_BaseParent):
     def remove_child_by_id(self, id):
         for i,child in enumerate(self._children):
             if child.id == id:
-                self._children.pop(i)
+                self.pop(i)
                 break
         else:
             raise ValueError(f'Child with id {id} not found!')
@@ -238,9 +499,10 @@ class AppState(_BaseParent):
         assert isinstance(child, Tab), f'Child is of type {type(child)}, but expected it to be of type Tab'
         return super().add_child(child)
 
-    @property
+    @cached_selector
     def selector(self):
         return '' if self.parent is None else self.parent.selector
 
 
-base_class_dict = {cls.__name__:cls for cls in _Base._get_all_subclasses()}
+_Base.class_registry['_Base'] = _Base
+base_class_dict = dict(_Base.class_registry)
@@ -0,0 +1,487 @@
+# benchmark.py
+# Rough timing of the heavy numerical paths, the state tree and instrument I/O against simulated instruments.
+# Run as a script: prints a table per benchmark and saves every measured row to a JSON file, e.g.
+#     python benchmark.py --only sample_wf tree --compare .benchmarks/benchmark-20240101-120000.json
+# Keys ending in _s are times (lower is better), keys ending in _per_s are rates (higher is better). --compare flags both.
+import os, sys, time, tracemalloc, tempfile, json, argparse, platform, subprocess
+import numpy as np
+import pyvisa
+import DHO1000_test, DG2000, acquisition, sweep
+from app_base import sample_cache, TemplateWF, _BaseParent, AppState, Tab, AWGSettings, AWGChannelSettings
+from data import find_shift, CaptureStore, Data
+from templatewf import (PUNDTemplateWF, SineTemplateWF, ConstantTemplateWF, ArbitraryTemplateWF, CollectionTemplateWF,
+                        rational_ratio, wf_class_dict)
+from persistence import StateJournal
+from serialization import pack
+from sim_instruments import SimulatedInstrument, SimulatedDHO1000, SimulatedDG2000
+
+RESULTS_DIR = './.benchmarks/'
+REGRESSION_THRESHOLD = 1.2 # --compare flags metrics that got this much worse
+MIN_COMPARED_TIME = 1e-4 # s. Timings shorter than this in both runs are mostly noise and not compared
+results:dict[str,list[dict]] = {} # benchmark name -> rows of metrics, in the order they were measured
+
+
+def timeit(func, *args, repeat:int=3, **kwargs)->float:
+    '''Best-of-repeat wall time of func(*args, **kwargs), in seconds'''
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter()-t0)
+    return best
+
+def peak_memory(func, *args, **kwargs)->float:
+    '''Peak memory allocated (through tracemalloc, which numpy reports to) while running func, in bytes'''
+    tracemalloc.start()
+    func(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def record(bench:str, **metrics):
+    '''Keep one row of results for the JSON output. NaN (not measured) is stored as null.'''
+    results.setdefault(bench, []).append({k:(None if isinstance(v, float) and np.isnan(v) else v) for k,v in pack(metrics).items()})
+
+def bench_data_shift(lengths=(1e4, 1e5, 1e6, 1e7, 5e7), full_max:float=1e7, coarse_factor:int=64):
+    '''Alignment time for a synthetic PUND-like capture, full FFT cross-correlation vs coarse-to-fine.
+    Full-rate correlation of very long captures needs a lot of RAM, so it is skipped above full_max.'''
+    rng = np.random.default_rng(0)
+    print(f'{"N":>10} {"full (ms)":>10} {"c2f (ms)":>10} {"true":>10} {"full est":>10} {"c2f est":>10}')
+    for n in map(int, lengths):
+        t = np.arange(n)
+        ideal = 1 - np.abs(((t/(n/16)) % 2) - 1) # triangle train, 8 periods
+        ideal[(t < 0.2*n) | (t > 0.8*n)] = 0 # flat before and after, like a capture around the trigger
+        true_shift = n//37 + 0.3
+        data = np.interp(t - true_shift, t, ideal) + 0.01*rng.standard_normal(n)
+        if n <= full_max:
+            t_full = timeit(find_shift, data, ideal)
+            est_full = f'{find_shift(data, ideal):.2f}'
+        else:
+            t_full, est_full = np.nan, '-'
+        t_c2f = timeit(find_shift, data, ideal, coarse_factor=coarse_factor)
+        est_c2f = find_shift(data, ideal, coarse_factor=coarse_factor)
+        record('data_shift', n=n, full_s=t_full, c2f_s=t_c2f, true_shift=true_shift, c2f_shift=est_c2f)
+        print(f'{n:>10} {t_full*1e3:>10.1f} {t_c2f*1e3:>10.1f} {true_shift:>10.2f} {est_full:>10} {est_c2f:>10.2f}')
+    check_shift_collection()
+
+def check_shift_collection(shifts=(37, -120, 1003), coarse_factors=(None, 8, 64), sample_rate:float=1e8):
+    '''Regression check: find_shift on a noiseless PUND collection (flat lead-in and tail, like a real capture) shifted by a
+    whole number of samples must find that shift exactly, in full and in coarse-to-fine mode'''
+    coll = CollectionTemplateWF(ConstantTemplateWF(0, 2e-4), PUNDTemplateWF(rise_time=1e-5, delay_time=2e-5, n_cycles=20), ConstantTemplateWF(0, 2e-4))
+    ideal = coll.sample_wf(sample_rate)
+    for shift in shifts:
+        data = np.roll(ideal, shift)
+        for q in coarse_factors:
+            est = find_shift(data, ideal, coarse_factor=q)
+            record('shift_collection', shift=shift, coarse_factor=q, estimate=est)
+            assert abs(est - shift) < 0.1, f'find_shift(coarse_factor={q}) found {est:.2f} for a shift of {shift} samples'
+    print(f'PUND collection, {len(ideal)} samples: shifts {shifts} found exactly with coarse_factor {coarse_factors}')
+
+
+def _pund_lambdas(block:PUNDTemplateWF, sample_rate:float)->np.ndarray:
+    '''The old quarter_PUND lambda sampler, kept here only to compare against'''
+    time = np.arange(0, block.n_cycles*(4*block.delay_time + 8*block.rise_time), 1/sample_rate)
+    quarter_PUND = lambda t, rise_time, period, quarter: np.abs((2 * (
+                                                                (t-period/4*quarter - period * np.floor((t-period/4*quarter) / (rise_time + period))) / rise_time -
+                                                                np.floor((t-period/4*quarter - period * np.floor((t-period/4*quarter) / (rise_time + period))) / rise_time + 0.5)))
+                                                            ) * ((t-period/4*quarter) % (rise_time + period) < rise_time)
+    pund = lambda t, rise_time, delay_time: + quarter_PUND(t, rise_time, rise_time*8+delay_time*4, 0) \
+                                            + quarter_PUND(t, rise_time, rise_time*8+delay_time*4, 1) \
+                                            - quarter_PUND(t, rise_time, rise_time*8+delay_time*4, 2) \
+                                            - quarter_PUND(t, rise_time, rise_time*8+delay_time*4, 3)
+    return block.offset + block.amplitude*pund(time, block.rise_time, block.delay_time)
+
+def bench_pund_sampler(sample_rate:float=1e9, n_cycles:float=1):
+    '''PUNDTemplateWF.sample_wf against the old lambda sampler, plus a bit-exactness check against np.interp of the skeleton'''
+    pund = PUNDTemplateWF(n_cycles=n_cycles)
+    TemplateWF.tile_periods = False # compare the sampler itself, not the tiling
+    def sample():
+        sample_cache.clear()
+        return pund.sample_wf(sample_rate)
+    t_new, t_old = timeit(sample), timeit(_pund_lambdas, pund, sample_rate)
+    m_new, m_old = peak_memory(sample), peak_memory(_pund_lambdas, pund, sample_rate)
+    exact = np.array_equal(sample(), np.interp(pund.get_time_array(sample_rate), *pund.get_skeleton()))
+    print(f'PUND at {sample_rate:.0e} Sa/s, {len(sample())} samples')
+    print(f'{"":>10} {"time (ms)":>10} {"peak (MB)":>10}')
+    print(f'{"lambdas":>10} {t_old*1e3:>10.1f} {m_old/2**20:>10.1f}')
+    print(f'{"piecewise":>10} {t_new*1e3:>10.1f} {m_new/2**20:>10.1f}')
+    print(f'bit-identical to np.interp of skeleton: {exact}')
+    record('pund_sampler', sample_rate=sample_rate, lambdas_s=t_old, piecewise_s=t_new, lambdas_bytes=m_old, piecewise_bytes=m_new, exact=exact)
+    TemplateWF.tile_periods = True
+
+def bench_periodic(sample_rate:float=1e8, n_cycles=(1, 10, 100)):
+    '''sample_wf with and without tiling one period, for PUND and sine blocks of increasing n_cycles'''
+    print(f'{"block":>6} {"cycles":>7} {"direct (ms)":>12} {"tiled (ms)":>11} {"max diff":>9}')
+    for cls, kwargs in ((PUNDTemplateWF, {}), (SineTemplateWF, dict(freq=1e5))):
+        for n in n_cycles:
+            block = cls(n_cycles=n, **kwargs)
+            res = {}
+            for tile in (False, True):
+                TemplateWF.tile_periods = tile
+                def sample():
+                    sample_cache.clear()
+                    return block.sample_wf(sample_rate)
+                res[tile] = timeit(sample), sample()
+            TemplateWF.tile_periods = True
+            diff = np.abs(res[True][1] - res[False][1]).max()
+            record('periodic', block=cls.__name__, n_cycles=n, direct_s=res[False][0], tiled_s=res[True][0], max_diff=diff)
+            print(f'{cls.__name__[:-10]:>6} {n:>7} {res[False][0]*1e3:>12.1f} {res[True][0]*1e3:>11.1f} {diff:>9.1e}')
+
+def open_simulated(sim:SimulatedInstrument):
+    rm = pyvisa.ResourceManager('@py')
+    oscope = rm.open_resource(sim.resource_name, read_termination='\n', write_termination='\n', timeout=60000)
+    oscope.chunk_size = 2**20 # the default 20 kB reads make large transfers needlessly slow
+    return oscope
+
+def bench_transfer(points=(1e5, 1e6, 1e7), bandwidth:float|None=None):
+    '''Raw waveform download from the simulated scope: one query_binary_values into a list, vs chunked reads into a preallocated buffer'''
+    print(f'{"points":>10} {"list (s)":>9} {"list (MB)":>10} {"chunked (s)":>12} {"chunked (MB)":>13}')
+    with SimulatedDHO1000(bandwidth=bandwidth) as sim:
+        oscope = open_simulated(sim)
+        for pts in map(int, points):
+            DHO1000_test.send(oscope, [f':acq:mdep {pts}', ':wav:sour CHAN1', ':wav:mode RAW', ':wav:form WORD', ':wav:start 1', f':wav:stop {pts}'])
+            sim._capture(1) # generate the capture up front, outside the timings
+            def as_list():
+                oscope.write(f':wav:start 1;:wav:stop {pts}')
+                return np.array(oscope.query_binary_values(':wav:data?', datatype='H'), dtype=np.uint16)
+            chunked = lambda: DHO1000_test.read_waveform(oscope, pts, 'WORD')
+            assert np.array_equal(as_list(), chunked())
+            t_list, t_chunked = timeit(as_list, repeat=1), timeit(chunked, repeat=1)
+            m_list, m_chunked = peak_memory(as_list), peak_memory(chunked)
+            record('transfer', points=pts, list_s=t_list, chunked_s=t_chunked, list_bytes=m_list, chunked_bytes=m_chunked)
+            print(f'{pts:>10} {t_list:>9.2f} {m_list/2**20:>10.1f} {t_chunked:>12.2f} {m_chunked/2**20:>13.1f}')
+        oscope.close()
+
+def bench_binning(n:int=int(1e8), n_bins:int=2000):
+    '''Display envelope of a memory-mapped capture, binned from the raw samples vs served from the stored pyramid'''
+    store = CaptureStore(tempfile.mkdtemp())
+    raw = (32768 + 1000*np.sin(np.arange(n)*1e-5)).astype('<u2')
+    cid = store.save({1:dict(raw_data=raw, x_increment=1e-9, x_offset=0., y_increment=1e-3, y_offset=0.)})
+    del raw
+    t_build = timeit(store.build_pyramid, cid, 1, repeat=1)
+    flat, pyr = Data(store.raw(cid, 1), 1e9), Data.from_capture(store, cid, 1)
+    print(f'{n:.0e} samples, pyramid built in {t_build:.2f} s')
+    print(f'{"view":>12} {"raw (ms)":>9} {"pyramid (ms)":>13}')
+    for name, sl in (('full', slice(None)), ('zoom 1/10', slice(n//2, n//2 + n//10)), ('zoom 1/1000', slice(n//2, n//2 + n//1000))):
+        t_raw, t_pyr = timeit(flat.envelope, n_bins, sl), timeit(pyr.envelope, n_bins, sl)
+        record('binning', n=n, view=name, build_s=t_build, raw_s=t_raw, pyramid_s=t_pyr)
+        print(f'{name:>12} {t_raw*1e3:>9.1f} {t_pyr*1e3:>13.1f}')
+
+def bench_parallel(n_scopes:int=2, points:int=int(1e6), bandwidth:float=10e6, n_captures:int=4):
+    '''Cycle time for several simulated scopes with two channels each: one after another, all in parallel,
+    and in parallel with readout overlapping a (simulated) analysis as long as one readout.
+    Scopes and client share one python process here, so the link has to be the bottleneck (as on the real LAN) to see the overlap.'''
+    sims = [SimulatedDHO1000(bandwidth=bandwidth).start() for _ in range(n_scopes)]
+    scopes = [open_simulated(sim) for sim in sims]
+    for oscope in scopes:
+        DHO1000_test.send(oscope, [':chan1:disp 1', ':chan2:disp 1', f':acq:mdep {points}', ':tim:main:scal 1e-3'])
+    def serial():
+        for oscope in scopes:
+            acquisition.arm(oscope)
+            acquisition.trigger_and_read(oscope)
+    acquisition.acquire(scopes) # generate the simulated captures outside the timings
+    t_single = timeit(acquisition.acquire, scopes[:1], repeat=1)
+    t_serial = timeit(serial, repeat=1)
+    t_parallel = timeit(acquisition.acquire, scopes, repeat=1)
+    analyze = lambda captures: time.sleep(t_single)
+    t0 = time.perf_counter()
+    for _ in acquisition.acquire_pipelined(scopes, n_captures, analyze):
+        pass
+    t_pipelined = (time.perf_counter()-t0)/n_captures
+    record('parallel', n_scopes=n_scopes, points=points, bandwidth=bandwidth,
+           single_s=t_single, serial_s=t_serial, parallel_s=t_parallel, pipelined_s=t_pipelined)
+    print(f'{n_scopes} scopes x 2 channels x {points:.0e} points at {bandwidth/1e6:.0f} MB/s')
+    print(f'{"one scope":>24} {t_single:>6.2f} s')
+    print(f'{"serial":>24} {t_serial:>6.2f} s')
+    print(f'{"parallel":>24} {t_parallel:>6.2f} s')
+    print(f'{"parallel + analysis":>24} {t_pipelined:>6.2f} s per capture (analysis alone {t_single:.2f} s)')
+    for oscope, sim in zip(scopes, sims):
+        oscope.close()
+        sim.stop()
+
+def _arbitrary_state(n_points:int)->AppState:
+    state = AppState()
+    tab = Tab(id='tab', name='tab')
+    state.add_child(tab)
+    awg = AWGSettings()
+    tab.add_child(awg)
+    chan = AWGChannelSettings(channel=1)
+    awg.add_child(chan)
+    chan.add_child(CollectionTemplateWF(ArbitraryTemplateWF(np.sin(np.arange(n_points)*1e-3), init_sample_rate=1e9)))
+    return state
+
+def bench_serialization(n_points:int=int(1e7)):
+    '''Saving and loading a state holding an n_points arbitrary waveform: plain JSON with the samples as a list,
+    vs a journal snapshot with the samples as an out-of-band blob'''
+    state = _arbitrary_state(n_points)
+    to_json = lambda: json.dumps(state.to_dict(), default=lambda a: a.tolist()) # how an ndarray has to go into plain JSON
+    t_json = timeit(to_json, repeat=1)
+    text = to_json()
+    t_json_load = timeit(lambda: AppState.from_dict(json.loads(text)), repeat=1)
+    journal = StateJournal(tempfile.mkdtemp())
+    t_first = timeit(journal.snapshot, state, repeat=1) # hashes and writes the blob
+    t_snap = timeit(journal.snapshot, state)
+    t_load = timeit(StateJournal(journal.root).load)
+    snapshot_len = os.path.getsize(os.path.join(journal.root, f'snapshot-{journal.seq}.json'))
+    record('serialization', n_points=n_points, json_save_s=t_json, json_load_s=t_json_load, json_bytes=len(text),
+           blob_first_save_s=t_first, blob_save_s=t_snap, blob_load_s=t_load, snapshot_bytes=snapshot_len)
+    print(f'{n_points:.0e} point arbitrary waveform')
+    print(f'{"":>16} {"save (ms)":>10} {"load (ms)":>10} {"JSON (kB)":>10}')
+    print(f'{"json lists":>16} {t_json*1e3:>10.1f} {t_json_load*1e3:>10.1f} {len(text)/1e3:>10.0f}')
+    print(f'{"blob, first save":>16} {t_first*1e3:>10.1f} {"":>10} {"":>10}')
+    print(f'{"blob":>16} {t_snap*1e3:>10.1f} {t_load*1e3:>10.1f} {snapshot_len/1e3:>10.1f}')
+
+def bench_resample(n_points:int=int(1e6), init_sample_rate:float=3e8, rates=(1e9, 1.2e9, 1.5e8, 3e8*np.pi)):
+    '''ArbitraryTemplateWF resampling against np.interp of the same samples: throughput, and worst error against the
+    analytic signal (two tones, well below both Nyquist frequencies) away from the ends'''
+    f = (init_sample_rate/30, init_sample_rate/7)
+    signal = lambda t: np.sin(2*np.pi*f[0]*t) + 0.5*np.cos(2*np.pi*f[1]*t)
+    t_in = np.arange(n_points)/init_sample_rate
+    block = ArbitraryTemplateWF(signal(t_in), init_sample_rate)
+    print(f'{n_points:.0e} points at {init_sample_rate:.2e} Sa/s')
+    print(f'{"rate (Sa/s)":>12} {"method":>11} {"interp (Msa/s)":>15} {"block (Msa/s)":>14} {"interp err":>11} {"block err":>10}')
+    for rate in rates:
+        t_out = np.arange(block.n_samples(rate))/rate
+        def sample():
+            sample_cache.clear()
+            return block.sample_wf(rate)
+        t_interp, t_block = timeit(np.interp, t_out, t_in, block.values), timeit(sample)
+        mid = slice(len(t_out)//10, -len(t_out)//10)
+        # components above the output Nyquist frequency are filtered out on purpose, so leave them out of the reference
+        ref = sum(a*np.cos(2*np.pi*fk*t_out - ph) for a, fk, ph in ((1, f[0], np.pi/2), (0.5, f[1], 0)) if fk < 0.4*rate)
+        err_interp = np.abs(np.interp(t_out, t_in, block.values) - ref)[mid].max()
+        err_block = np.abs(sample() - ref)[mid].max()
+        method = 'polyphase' if rational_ratio(rate, init_sample_rate) else 'fractional'
+        record('resample', n_points=n_points, rate=rate, method=method, interp_samples_per_s=len(t_out)/t_interp,
+               block_samples_per_s=len(t_out)/t_block, interp_err=err_interp, block_err=err_block)
+        print(f'{rate:>12.3e} {method:>11} {len(t_out)/t_interp/1e6:>15.1f} {len(t_out)/t_block/1e6:>14.1f} {err_interp:>11.1e} {err_block:>10.1e}')
+    check_large_upsampling()
+
+def check_large_upsampling(n_points:int=200, init_sample_rate:float=1e5, rate:float=1e9):
+    '''Regression check: ratios whose numerator exceeds max_polyphase_up must go through resample_fractional instead of
+    building a huge polyphase filter, including the default (empty, 1 Sa/s) block added from the GUI'''
+    assert rational_ratio(rate, init_sample_rate, ArbitraryTemplateWF.max_polyphase_up) is None
+    assert rational_ratio(rate, 1, ArbitraryTemplateWF.max_polyphase_up) is None
+    assert len(ArbitraryTemplateWF().sample_wf(rate)) == 0
+    block = ArbitraryTemplateWF(np.sin(np.arange(n_points)*0.1), init_sample_rate)
+    def sample():
+        sample_cache.clear()
+        return block.sample_wf(rate)
+    t_block = timeit(sample, repeat=1)
+    t_out = np.arange(block.n_samples(rate))/rate
+    err = np.abs(sample() - np.sin(t_out*init_sample_rate*0.1))[len(t_out)//10:-len(t_out)//10].max()
+    record('resample_large_up', n_points=n_points, init_sample_rate=init_sample_rate, rate=rate, block_s=t_block, block_err=err)
+    print(f'{n_points} points from {init_sample_rate:.0e} to {rate:.0e} Sa/s (fractional): {t_block:.2f} s, max error {err:.1e}')
+    assert err < 1e-3, f'upsampling by {rate/init_sample_rate:.0f} is off by {err:.1e}'
+
+def bench_sweep(n_points:int=12, bandwidth:float=10e6):
+    '''PUND amplitude sweep through the three stage pipeline, acquiring from a simulated scope.
+    Compares the wall time per point with the sum of the stage times, which is what running them one after another costs.'''
+    tab = Tab(id='sweep', name='sweep')
+    awg = AWGSettings()
+    tab.add_child(awg)
+    for ch in (1, 2):
+        chan = AWGChannelSettings(channel=ch, sample_rate=1e9)
+        awg.add_child(chan)
+        chan.add_child(CollectionTemplateWF(PUNDTemplateWF(n_cycles=4)))
+    grid = sweep.parameter_grid(**{'PUNDTemplateWF.amplitude': np.linspace(0.5, 3, n_points)})
+    with SimulatedDHO1000(bandwidth=bandwidth) as sim:
+        oscope = open_simulated(sim)
+        DHO1000_test.send(oscope, [':chan1:disp 1', ':chan2:disp 1', ':acq:mdep 1000000', ':tim:main:scal 1e-3'])
+        acquisition.acquire([oscope]) # generate the simulated captures outside the timings
+        analyze = lambda point, tab, captures: {ch:float(np.abs(info['raw_data'].astype(float) - 32768).sum()) for ch, info in captures[0].items()}
+        run = sweep.Sweep(tab, grid, sweep.instrument_acquire(None, [oscope], full_scale=5), analyze, tempfile.mkdtemp())
+        run.run()
+        oscope.close()
+    serial = sum(np.sum(run.timing[stage]) for stage in sweep.STAGES)/n_points
+    record('sweep', n_points=n_points, bandwidth=bandwidth, wall_per_point_s=run.wall_time/n_points, serial_per_point_s=serial,
+           **{f'{stage}_s':float(np.mean(run.timing[stage])) for stage in sweep.STAGES})
+    print(f'{n_points} point sweep, 2 x 1e6 point captures at {bandwidth/1e6:.0f} MB/s')
+    print(run.timing_report())
+    print(f'{"serial":<12} {serial*1e3:>10.1f}')
+
+
+def _wf_blocks(sample_rate:float)->dict[str,TemplateWF]:
+    '''One block of every implemented TemplateWF, each a few ms long. The TODO classes have no sampler yet and are left out.'''
+    rng = np.random.default_rng(0)
+    blocks = dict(PUNDTemplateWF=PUNDTemplateWF(rise_time=100e-6, delay_time=100e-6, n_cycles=4),
+                  SineTemplateWF=SineTemplateWF(freq=1e4, n_cycles=40),
+                  ConstantTemplateWF=ConstantTemplateWF(value=1, duration=4e-3),
+                  ArbitraryTemplateWF=ArbitraryTemplateWF(rng.standard_normal(int(4e-3*sample_rate/3)), init_sample_rate=sample_rate/3))
+    blocks['CollectionTemplateWF'] = CollectionTemplateWF(*(_BaseParent.from_dict(b.to_dict()) for b in blocks.values()))
+    return blocks
+
+def bench_sample_wf(sample_rate:float=1e8):
+    '''sample_wf of every TemplateWF, from an empty sample cache, and from the cache'''
+    blocks = _wf_blocks(sample_rate)
+    print(f'{"block":>22} {"samples":>9} {"cold (ms)":>10} {"cached (ms)":>12} {"Msa/s":>8}')
+    for name, block in blocks.items():
+        def sample():
+            sample_cache.clear()
+            return block.sample_wf(sample_rate)
+        n = len(sample())
+        t_cold, t_cached = timeit(sample), timeit(block.sample_wf, sample_rate)
+        record('sample_wf', block=name, sample_rate=sample_rate, samples=n, cold_s=t_cold, cached_s=t_cached)
+        print(f'{name:>22} {n:>9} {t_cold*1e3:>10.2f} {t_cached*1e3:>12.3f} {n/t_cold/1e6:>8.0f}')
+    skipped = [name for name in wf_class_dict if name not in blocks and name != 'TemplateWF']
+    if skipped:
+        print(f'not implemented yet: {", ".join(skipped)}')
+
+def bench_collection(n_blocks=(10, 100, 1000), sample_rate:float=1e9):
+    '''CollectionTemplateWF.get_skeleton and get_ROIs for collections of alternating PUND and sine blocks'''
+    print(f'{"blocks":>7} {"skeleton (ms)":>14} {"ROIs (ms)":>10} {"ROIs":>6}')
+    for n in n_blocks:
+        coll = CollectionTemplateWF(*(PUNDTemplateWF(n_cycles=1) if i % 2 == 0 else SineTemplateWF(n_cycles=1) for i in range(n)))
+        t_skeleton, t_rois = timeit(coll.get_skeleton), timeit(coll.get_ROIs, sample_rate)
+        n_rois = len(coll.get_ROIs(sample_rate))
+        record('collection', n_blocks=n, skeleton_s=t_skeleton, rois_s=t_rois, n_rois=n_rois)
+        print(f'{n:>7} {t_skeleton*1e3:>14.2f} {t_rois*1e3:>10.2f} {n_rois:>6}')
+
+def _large_state(n_tabs:int, blocks_per_channel:int)->AppState:
+    '''n_tabs tabs, each with a two channel AWG holding blocks_per_channel PUND blocks per channel'''
+    state = AppState()
+    for i in range(n_tabs):
+        tab = Tab(id=f'tab{i}', name=f'tab {i}')
+        state.add_child(tab)
+        awg = AWGSettings()
+        tab.add_child(awg)
+        for ch in (1, 2):
+            chan = AWGChannelSettings(channel=ch)
+            awg.add_child(chan)
+            chan.add_child(CollectionTemplateWF(*(PUNDTemplateWF() for _ in range(blocks_per_channel))))
+    return state
+
+def bench_tree(sizes=((10, 50), (50, 200), (100, 500)), n_lookups:int=10000):
+    '''find_by_py_id on large trees, from the root and from a tab, and a to_dict/JSON/from_dict round trip'''
+    print(f'{"elements":>9} {"lookup (us)":>12} {"tab lookup (us)":>16} {"to_dict (ms)":>13} {"dumps (ms)":>11} {"from_dict (ms)":>15}')
+    rng = np.random.default_rng(0)
+    for n_tabs, blocks_per_channel in sizes:
+        state = _large_state(n_tabs, blocks_per_channel)
+        ids = []
+        state.apply(lambda e: ids.append(e.py_id))
+        lookup = rng.choice(ids, n_lookups).tolist()
+        tab = state._children[n_tabs//2]
+        t_find = timeit(lambda: [state.find_by_py_id(i) for i in lookup])/n_lookups
+        t_tab_find = timeit(lambda: [tab.find_by_py_id(i) for i in lookup])/n_lookups
+        t_to_dict = timeit(state.to_dict)
+        text = json.dumps(state.to_dict())
+        t_dumps = timeit(json.dumps, state.to_dict())
+        t_from_dict = timeit(lambda: _BaseParent.from_dict(json.loads(text)))
+        assert json.dumps(_BaseParent.from_dict(json.loads(text)).to_dict()) == text, 'to_dict/from_dict round trip changed the state'
+        record('tree', elements=len(ids), lookup_s=t_find, tab_lookup_s=t_tab_find, to_dict_s=t_to_dict,
+               dumps_s=t_dumps, from_dict_s=t_from_dict, json_bytes=len(text))
+        print(f'{len(ids):>9} {t_find*1e6:>12.2f} {t_tab_find*1e6:>16.2f} {t_to_dict*1e3:>13.1f} {t_dumps*1e3:>11.1f} {t_from_dict*1e3:>15.1f}')
+
+def bench_end_to_end(n_captures:int=5, points:int=int(1e6), n_channels:int=2, latency:float=1e-3, bandwidth:float|None=50e6,
+                     sample_rate:float=1e8):
+    '''Full measurement cycles against a simulated AWG and scope, as DHO1000_test.py runs them on the bench:
+    reset, vconfig and hconfig once, then per capture upload the waveform (DG2000.send_arb), arm, force_trigger and get_data.
+    latency (s per query response) and bandwidth (bytes/s each way, None for unlimited) apply to both instruments.'''
+    wf = CollectionTemplateWF(PUNDTemplateWF(rise_time=100e-6, delay_time=100e-6, n_cycles=4))
+    with SimulatedDHO1000(latency=latency, bandwidth=bandwidth) as sim_scope, SimulatedDG2000(latency=latency, bandwidth=bandwidth) as sim_awg:
+        oscope, awg = open_simulated(sim_scope), open_simulated(sim_awg)
+        t0 = time.perf_counter()
+        DHO1000_test.reset(oscope)
+        for ch in range(1, n_channels+1):
+            DHO1000_test.vconfig(oscope, channel=ch, vscale=0.1, voffset=0)
+        DHO1000_test.hconfig(oscope, hscale=1e-3, memorydepth=points)
+        t_setup = time.perf_counter() - t0
+        t = dict(upload=[], arm=[], trigger=[], read=[])
+        for _ in range(n_captures):
+            sample_cache.clear() # a sweep renders a new waveform every time
+            t0 = time.perf_counter()
+            DG2000.send_arb(awg, 1, wf.iter_chunks(sample_rate), full_scale=5)
+            awg.query('*OPC?') # the upload is only done once the AWG has taken all of it
+            t1 = time.perf_counter()
+            acquisition.arm(oscope)
+            t2 = time.perf_counter()
+            DHO1000_test.force_trigger(oscope)
+            t3 = time.perf_counter()
+            captures = DHO1000_test.get_data(oscope)
+            t4 = time.perf_counter()
+            for stage, dt in zip(t, (t1-t0, t2-t1, t3-t2, t4-t3)):
+                t[stage].append(dt)
+        assert len(sim_awg.waveforms[1]) == wf.n_samples(sample_rate) and len(captures) == n_channels
+        oscope.close()
+        awg.close()
+    cycle = sum(np.mean(ts) for ts in t.values())
+    read_bytes = 2*points*n_channels
+    record('end_to_end', points=points, n_channels=n_channels, latency=latency, bandwidth=bandwidth, setup_s=t_setup,
+           **{f'{stage}_s':float(np.mean(ts)) for stage, ts in t.items()}, cycle_s=cycle,
+           captures_per_s=1/cycle, read_bytes_per_s=read_bytes/np.mean(t['read']))
+    print(f'{n_captures} captures of {n_channels} x {points:.0e} points, {latency*1e3:.1f} ms latency, '
+          f'{"unlimited" if bandwidth is None else f"{bandwidth/1e6:.0f} MB/s"}, {wf.n_samples(sample_rate)} point AWG upload')
+    print(f'{"stage":<12} {"mean (ms)":>10}')
+    print(f'{"setup":<12} {t_setup*1e3:>10.1f}')
+    for stage, ts in t.items():
+        print(f'{stage:<12} {np.mean(ts)*1e3:>10.1f}')
+    print(f'{"cycle":<12} {cycle*1e3:>10.1f}  ({1/cycle:.2f} captures/s, readout {read_bytes/np.mean(t["read"])/1e6:.1f} MB/s)')
+
+
+BENCHMARKS = dict(data_shift=bench_data_shift, pund_sampler=bench_pund_sampler, periodic=bench_periodic,
+                  sample_wf=bench_sample_wf, collection=bench_collection, tree=bench_tree,
+                  transfer=bench_transfer, binning=bench_binning, parallel=bench_parallel, serialization=bench_serialization,
+                  resample=bench_resample, sweep=bench_sweep, end_to_end=bench_end_to_end)
+
+def metadata()->dict:
+    '''What the results were measured on, so runs on different machines or commits are not compared blindly'''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return dict(time=time.strftime('%Y-%m-%d %H:%M:%S'), commit=commit, python=platform.python_version(),
+                numpy=np.__version__, platform=platform.platform(), processor=platform.processor(), cpu_count=os.cpu_count())
+
+def save_results(path:str|None=None)->str:
+    '''Write the metadata and every recorded row to path (default RESULTS_DIR/benchmark-<time>.json)'''
+    if path is None:
+        path = os.path.join(RESULTS_DIR, f'benchmark-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(dict(metadata=metadata(), results=results), f, indent=4)
+    return path
+
+def compare(old:dict, new:dict, threshold:float=REGRESSION_THRESHOLD)->list[str]:
+    '''Metrics of new that are more than threshold times worse than in old. Rows are matched by position within each benchmark,
+    so only runs with the same benchmark parameters are comparable.'''
+    regressions = []
+    for bench, rows in new['results'].items():
+        for i, (row_old, row_new) in enumerate(zip(old['results'].get(bench, []), rows)):
+            for key, v_new in row_new.items():
+                v_old = row_old.get(key)
+                if not isinstance(v_new, (int, float)) or not isinstance(v_old, (int, float)) or v_old <= 0 or v_new <= 0:
+                    continue
+                if key.endswith('_per_s'):
+                    worse = v_old/v_new
+                elif key.endswith('_s') and max(v_old, v_new) >= MIN_COMPARED_TIME:
+                    worse = v_new/v_old
+                else:
+                    continue
+                if worse > threshold:
+                    regressions.append(f'{bench}[{i}].{key}: {v_old:.4g} -> {v_new:.4g} ({worse:.2f}x worse)')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run benchmarks, save the results as JSON and optionally compare them to an earlier run')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='benchmarks to run, default all')
+    parser.add_argument('--out', help=f'JSON file for the results, default {RESULTS_DIR}benchmark-<time>.json')
+    parser.add_argument('--compare', help='results JSON of an earlier run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='ratio above which a metric counts as a regression')
+    args = parser.parse_args()
+    for name in args.only or BENCHMARKS:
+        print(f'\n== {name} ==')
+        BENCHMARKS[name]()
+    path = save_results(args.out)
+    print(f'\nResults saved to {path}')
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        with open(path) as f:
+            new = json.load(f)
+        regressions = compare(old, new, args.threshold)
+        print(f'{len(regressions)} regressions against {args.compare} ({old["metadata"]["commit"]}, {old["metadata"]["time"]})')
+        for line in regressions:
+            print('   ' + line)
+        sys.exit(1 if regressions else 0)
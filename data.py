@@ -1,23 +1,317 @@
+import os, json, time, itertools
 import numpy as np
-from templatewf import WF_Block_Collection, WF_Block_PUND, WF_Block_Sine
+from numpy.lib.stride_tricks import as_strided
+from templatewf import CollectionTemplateWF
+
+
+def _next_fast_len(n:int)->int:
+    '''Smallest integer >= n whose only prime factors are 2, 3 and 5. FFTs of these lengths are fast.'''
+    best = 1 << max(int(n-1).bit_length(), 0)
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p235 = p35
+            while p235 < n: # multiply up by 2 until we are past n
+                p235 *= 2
+            best = min(best, p235)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+def _decimate(x:np.ndarray, factor:int)->np.ndarray:
+    '''Boxcar-average x by an integer factor, dropping any leftover samples at the end.'''
+    n = len(x)//factor
+    return x[:n*factor].reshape(n, factor).mean(axis=1)
+
+def _parabolic_peak(c:np.ndarray, i:int)->float:
+    '''Fit a parabola through c[i-1], c[i], c[i+1] and return the fractional offset of its vertex from i.'''
+    if i <= 0 or i >= len(c)-1:
+        return 0.
+    denom = c[i-1] - 2*c[i] + c[i+1]
+    if denom == 0:
+        return 0.
+    return 0.5*(c[i-1] - c[i+1])/denom
+
+def xcorr_fft(data:np.ndarray, ideal:np.ndarray)->tuple[np.ndarray, np.ndarray]:
+    '''Full cross-correlation of data against ideal, computed with FFTs in O(N log N).
+    Returns (lags, c) where c[i] = sum_n data[n]*ideal[n-lags[i]], so a peak at lag k means data is ideal delayed by k samples.
+    Means are removed first so DC offsets on the scope do not bias the peak.'''
+    data = np.asarray(data, dtype=float)
+    ideal = np.asarray(ideal, dtype=float)
+    L = _next_fast_len(len(data) + len(ideal) - 1)
+    spec = np.fft.rfft(data - data.mean(), L)
+    spec *= np.conj(np.fft.rfft(ideal - ideal.mean(), L))
+    c = np.fft.irfft(spec, L)
+    del spec
+    # reorder the circular result into lags -(len(ideal)-1) ... len(data)-1
+    c = np.concatenate( (c[L-len(ideal)+1:], c[:len(data)]) )
+    lags = np.arange(-len(ideal)+1, len(data))
+    return lags, c
+
+def find_shift(data:np.ndarray, ideal:np.ndarray, coarse_factor:int|None=None, refine_len:int=2**16)->float:
+    '''Estimate by how many samples data is delayed relative to ideal, to sub-sample precision.
+    If coarse_factor is given, both arrays are first boxcar-decimated by that factor and correlated,
+    then the estimate is refined at full rate using only a refine_len window of the template around its most active region.'''
+    if coarse_factor is None or coarse_factor <= 1 or len(ideal) <= refine_len:
+        lags, c = xcorr_fft(data, ideal)
+        i = int(np.argmax(c))
+        return float(lags[i] + _parabolic_peak(c, i))
+
+    # coarse pass on decimated copies
+    q = int(coarse_factor)
+    data_dec = _decimate(np.asarray(data, dtype=float), q)
+    ideal_dec = _decimate(np.asarray(ideal, dtype=float), q)
+    lags, c = xcorr_fft(data_dec, ideal_dec)
+    k0 = int(lags[np.argmax(c)])*q
+
+    # pick the refine_len segment of the template with the most corners (curvature), found from the decimated copy using running sums.
+    # Straight ramps and flat regions do not localize a correlation peak, corners do.
+    m = max(min(refine_len//q, len(ideal_dec)-2), 1)
+    csum = np.concatenate(( [0.], np.cumsum(np.abs(np.diff(ideal_dec, 2))) ))
+    s = int(np.argmax(csum[m:] - csum[:-m]))*q
+    seg = ideal[s:s + m*q]
+
+    # fine pass: correlate the segment against the data within +/- 2 coarse samples of the coarse estimate
+    w = 2*q
+    lo = max(s + k0 - w, 0)
+    hi = min(s + k0 + len(seg) + w, len(data))
+    if hi - lo < len(seg): # segment falls off the edge of the data, coarse estimate is all we have
+        return float(k0)
+    window = np.asarray(data[lo:hi], dtype=float)
+    lags, c = xcorr_fft(window, seg)
+    # normalized cross-correlation: divide by the norm of the (mean removed) data under the segment at each lag,
+    # otherwise the peak follows the local energy of the data instead of the shape of the segment
+    full = lags >= 0
+    full[full] = lags[full] <= len(window) - len(seg) # lags where the whole segment overlaps the window
+    lags, c = lags[full], c[full]
+    s1 = np.concatenate(( [0.], np.cumsum(window - window.mean()) ))
+    s2 = np.concatenate(( [0.], np.cumsum((window - window.mean())**2) ))
+    m = len(seg)
+    energy = (s2[m:] - s2[:-m]) - (s1[m:] - s1[:-m])**2/m
+    c = c/np.sqrt(np.maximum(energy, 1e-12*max(energy.max(), 1e-300)))
+    lags = lags + lo - s
+    valid = np.abs(lags - k0) <= w
+    lags, c = lags[valid], c[valid]
+    i = int(np.argmax(c))
+    return float(lags[i] + _parabolic_peak(c, i))
+
+
+def window_sums(data:np.ndarray, starts:np.ndarray, length:int)->np.ndarray:
+    '''Sum of data[start:start+length] for every start, as one reduction over a stacked (len(starts), length) array.
+    Evenly spaced windows are stacked as a strided view of data, so nothing is copied.'''
+    starts = np.asarray(starts, dtype=int)
+    if len(starts) == 0:
+        return np.empty(0)
+    step = starts[1]-starts[0] if len(starts) > 1 else 1
+    if step > 0 and np.all(np.diff(starts) == step):
+        stacked = as_strided(data[starts[0]:], shape=(len(starts), length), strides=(step*data.strides[0], data.strides[0]), writeable=False)
+    else: # uneven spacing, gather (this copies)
+        stacked = data[starts[:,None] + np.arange(length)]
+    return stacked.sum(axis=1, dtype=float)
+
+
+BIN_REDUCTIONS = dict(mean=lambda b: b.mean(axis=1, dtype=float), min=lambda b: b.min(axis=1), max=lambda b: b.max(axis=1))
+BIN_REDUCTIONS['boxcar'] = BIN_REDUCTIONS['mean'] # a boxcar filter of width factor, then keeping every factor-th sample
+
+def bin_array(x:np.ndarray, factor:int, how:str='mean', out:np.ndarray|None=None, chunk:int=2**22)->np.ndarray:
+    '''Reduce every factor consecutive samples of x to one ('mean'/'boxcar', 'min' or 'max'), dropping leftover samples at the end.
+    Works through x about chunk samples at a time with a reshape-and-reduce, so x can be a memory map much larger than RAM.'''
+    assert factor >= 1, 'factor must be a positive integer'
+    n = len(x)//factor
+    if out is None:
+        out = np.empty(n, dtype=x.dtype if how in ('min', 'max') else float)
+    reduce = BIN_REDUCTIONS[how]
+    step = max(chunk//factor, 1) # output samples per chunk
+    for i in range(0, n, step):
+        j = min(i+step, n)
+        out[i:j] = reduce(np.asarray(x[i*factor:j*factor]).reshape(j-i, factor))
+    return out
+
+
+class CaptureStore:
+    '''Raw oscilloscope captures on disk. Each capture is a directory holding ch{n}.npy (raw uint16 samples, memory-mappable)
+    and capture.json (scaling for each channel plus any extra metadata). capture.json is written last, so a capture without it is incomplete.'''
+    def __init__(self, root:str='./.captures/'):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+    def _path(self, capture_id:str, fname:str='')->str:
+        return os.path.join(self.root, capture_id, fname)
+    def save(self, wf_info:dict, **metadata)->str:
+        '''Save the output of DHO1000_test.get_data. Returns the new capture's id.'''
+        # the clock can be too coarse to tell back to back saves apart (about 15 ms on Windows), so a counter breaks ties
+        for n in itertools.count():
+            capture_id = f'capture-{time.time():.6f}' + (f'-{n}' if n else '')
+            try:
+                os.makedirs(self._path(capture_id))
+                break
+            except FileExistsError:
+                continue
+        channels = {}
+        for ch, info in wf_info.items():
+            np.save(self._path(capture_id, f'ch{ch}.npy'), info['raw_data'])
+            channels[str(ch)] = {k:e for k,e in info.items() if k != 'raw_data'}
+        with open(self._path(capture_id, 'capture.json'), 'w') as f:
+            json.dump(dict(channels=channels, **metadata), f)
+        return capture_id
+    def list(self)->list[str]:
+        '''Ids of all complete captures, oldest first'''
+        return sorted(d for d in os.listdir(self.root) if os.path.isfile(self._path(d, 'capture.json')))
+    def info(self, capture_id:str)->dict:
+        with open(self._path(capture_id, 'capture.json')) as f:
+            return json.load(f)
+    def raw(self, capture_id:str, channel:int)->np.ndarray:
+        '''Read-only memory map of a channel's raw samples. Nothing is read from disk until it is indexed.'''
+        return np.load(self._path(capture_id, f'ch{channel}.npy'), mmap_mode='r')
+    def build_pyramid(self, capture_id:str, channel:int, factors:tuple[int]=(10, 100, 1000)):
+        '''Store binned copies (mean, min and max) of a channel at each factor next to the raw data, as ch{n}.x{factor}.{how}.npy.
+        Each level is binned from the previous one when its factor divides, so the raw data is only read once.
+        Levels are written to a temporary file and renamed, so pyramid() never sees a half written level.'''
+        raw = self.raw(capture_id, channel)
+        prev, prev_factor = dict(mean=raw, min=raw, max=raw), 1
+        for factor in sorted(factors):
+            if factor % prev_factor != 0:
+                prev, prev_factor = dict(mean=raw, min=raw, max=raw), 1
+            level = {}
+            for how in ('mean', 'min', 'max'):
+                src = prev[how]
+                path = self._path(capture_id, f'ch{channel}.x{factor}.{how}.npy')
+                out = np.lib.format.open_memmap(path + '.tmp', mode='w+',
+                                                dtype=np.float32 if how == 'mean' else raw.dtype, shape=(len(src)//(factor//prev_factor),))
+                bin_array(src, factor//prev_factor, how, out=out)
+                out.flush()
+                del out
+                os.replace(path + '.tmp', path)
+                level[how] = np.load(path, mmap_mode='r')
+            prev, prev_factor = level, factor
+    def pyramid(self, capture_id:str, channel:int)->dict[int, dict[str,np.ndarray]]:
+        '''Memory maps of the stored binned levels of a channel, {factor: {'mean':..., 'min':..., 'max':...}}'''
+        levels = {}
+        prefix = f'ch{channel}.x'
+        for fname in os.listdir(self._path(capture_id)):
+            if fname.startswith(prefix) and fname.endswith('.npy'):
+                factor, how, _ = fname[len(prefix):].split('.')
+                levels.setdefault(int(factor), {})[how] = np.load(self._path(capture_id, fname), mmap_mode='r')
+        return dict(sorted(levels.items()))
 
 
 class Data:
-    def _calculate_data_shift(self)->int:
+    def _calculate_data_shift(self)->float:
         '''Use cross correlation to the template waveform to determine if data is shifted'''
         ideal = self._template.sample_wf(self.sample_rate)
-        raise NotImplementedError
-        
-    def __init__(self, data:np.ndarray, sample_rate:float, template:WF_Block_Collection|None=None):
-        self._data = data
+        return find_shift(self._data, ideal, coarse_factor=self.coarse_factor) # an offset and positive scale do not move the peak, so raw data is fine
+
+    def __init__(self, data:np.ndarray, sample_rate:float, template:CollectionTemplateWF|None=None, coarse_factor:int|None=None,
+                 y_increment:float=1., y_offset:float=0., x_offset:float=0., pyramid:dict[int,dict[str,np.ndarray]]|None=None):
+        self._data = data # raw samples, possibly memory-mapped. volts = data*y_increment + y_offset
+        self._pyramid = pyramid if pyramid is not None else {} # stored binned levels, see CaptureStore.build_pyramid
         self.sample_rate = sample_rate
         self._template = template
-        self.binning = 1
-        
+        self.binning = 1 # default factor for binned()
+        self.coarse_factor = coarse_factor # if set, align with a decimated coarse pass first. Much faster for long captures.
+        self.y_increment = y_increment
+        self.y_offset = y_offset
+        self.x_offset = x_offset
+        self._rois:dict[str,slice]|None = None
+
         if self._template is not None:
             self.shift = self._calculate_data_shift()
         else:
             self.shift = 0
 
+    @classmethod
+    def from_capture(cls, store:CaptureStore, capture_id:str, channel:int, **kwargs):
+        '''Open one channel of a stored capture without loading it into memory'''
+        info = store.info(capture_id)['channels'][str(channel)]
+        return cls(store.raw(capture_id, channel), 1/info['x_increment'],
+                   y_increment=info['y_increment'], y_offset=info['y_offset'], x_offset=info['x_offset'],
+                   pyramid=store.pyramid(capture_id, channel), **kwargs)
+
+    def volts(self, sl:slice=slice(None))->np.ndarray:
+        '''Samples in sl converted to volts. Only that slice is read and converted.'''
+        return self._data[sl]*self.y_increment + self.y_offset
+
+    def roi_slices(self)->dict[str,slice]:
+        '''The template's ROIs, moved by the data shift. ROIs that fall outside the capture are left out.'''
+        if self._rois is None:
+            assert self._template is not None, 'ROIs need a template waveform'
+            s = int(round(self.shift))
+            self._rois = {lbl:slice(sl.start+s, sl.stop+s) for lbl,sl in self._template.get_ROIs(self.sample_rate).items()
+                          if sl.start+s >= 0 and sl.stop+s <= len(self._data)}
+        return self._rois
+
+    def roi(self, label:str, volts:bool=False)->np.ndarray:
+        '''Aligned data inside one ROI, e.g. 'P.0.3'. A view of the raw samples, or just that slice converted if volts is True.'''
+        sl = self.roi_slices()[label]
+        return self.volts(sl) if volts else self._data[sl]
+
+    def rois(self, volts:bool=False)->dict[str,np.ndarray]:
+        return {lbl:self.roi(lbl, volts) for lbl in self.roi_slices()}
+
+    def roi_integrals(self, labels:list[str])->np.ndarray:
+        '''Time integral (V s) of the data over each of the labelled ROIs, computed in one reduction per ROI length'''
+        rois = self.roi_slices()
+        res = np.empty(len(labels))
+        lengths = np.array([rois[lbl].stop - rois[lbl].start for lbl in labels], dtype=int)
+        starts = np.array([rois[lbl].start for lbl in labels], dtype=int)
+        for length in np.unique(lengths): # PUND blocks with different rise times have different pulse lengths
+            idx = np.flatnonzero(lengths == length)
+            raw_sums = window_sums(self._data, starts[idx], length)
+            res[idx] = (raw_sums*self.y_increment + length*self.y_offset)/self.sample_rate
+        return res
+
+    def pund_charges(self, transimpedance:float=1.)->dict[str,np.ndarray]:
+        '''Switching charge for every cycle: P-U and N-D integrals of the current (data/transimpedance).
+        Returns arrays ordered like the ROIs, keyed by 'P-U' and 'N-D'.'''
+        pulses = {}
+        for lbl in self.roi_slices():
+            prefix, _, rest = lbl.partition('.')
+            pulses.setdefault(prefix, []).append(rest)
+        res = {}
+        for a, b in (('P', 'U'), ('N', 'D')):
+            rests = [rest for rest in pulses.get(a, []) if rest in set(pulses.get(b, []))]
+            q = self.roi_integrals([f'{a}.{rest}' for rest in rests] + [f'{b}.{rest}' for rest in rests])/transimpedance
+            res[f'{a}-{b}'] = q[:len(rests)] - q[len(rests):]
+        return res
+
+    def times(self, sl:slice=slice(None))->np.ndarray:
+        '''Times of the samples in sl, relative to the trigger'''
+        return np.arange(*sl.indices(len(self._data)))/self.sample_rate + self.x_offset
+
+    def _binned_source(self, factor:int, how:str)->tuple[np.ndarray, int]:
+        '''The coarsest stored level (or the raw data) that factor is a multiple of, and its factor'''
+        for f in sorted(self._pyramid, reverse=True):
+            if factor % f == 0 and how in self._pyramid[f]:
+                return self._pyramid[f][how], f
+        return self._data, 1
+
+    def binned(self, factor:int|None=None, how:str='mean', sl:slice=slice(None), volts:bool=False)->np.ndarray:
+        '''Samples in sl (in raw sample indices) binned by factor (default self.binning), see bin_array.
+        Served from a stored pyramid level when one fits, so only the full-rate data that is really needed is read.'''
+        factor = self.binning if factor is None else factor
+        start, stop, _ = sl.indices(len(self._data))
+        start, stop = start//factor*factor, stop//factor*factor # bins line up with the start of the capture
+        src, f = self._binned_source(factor, 'mean' if how == 'boxcar' else how)
+        x = src[start//f:stop//f]
+        res = x if factor == f else bin_array(x, factor//f, how)
+        return res*self.y_increment + self.y_offset if volts else res
+
+    def binned_times(self, factor:int|None=None, sl:slice=slice(None))->np.ndarray:
+        '''Times of the first sample in each bin of binned(factor, sl=sl)'''
+        factor = self.binning if factor is None else factor
+        start, stop, _ = sl.indices(len(self._data))
+        return np.arange(start//factor, stop//factor)*(factor/self.sample_rate) + self.x_offset
+
+    def envelope(self, n_bins:int, sl:slice=slice(None), volts:bool=True)->tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''Min/max envelope of sl with at least n_bins bins, for display. Returns (times, lower, upper).
+        Bins from the coarsest stored level that still gives n_bins, so zoomed out views never touch the full-rate data,
+        and from the raw data if no level fits.'''
+        start, stop, _ = sl.indices(len(self._data))
+        factor = max((stop-start)//max(n_bins, 1), 1)
+        level = max([f for f in self._pyramid if f <= factor], default=1)
+        factor = factor//level*level # a multiple of the level, so binned() reads from it
+        lo, hi = (self.binned(factor, how, sl, volts) for how in ('min', 'max'))
+        return self.binned_times(factor, sl), lo, hi
+
 class DataPair:
-    pass
\ No newline at end of file
+    pass
@@ -0,0 +1,108 @@
+# jobs.py
+# Long running operations (instrument I/O, waveform upload) on worker threads, so eel callbacks return immediately.
+# Jobs only set plain attributes that the GUI thread reads, and never take locks: eel runs on gevent, whose monkey
+# patched locks must not be shared with real OS threads. State that job threads and the GUI do share guards itself with os_lock().
+import itertools, traceback, _thread
+from concurrent.futures import ThreadPoolExecutor
+
+
+def os_lock(reentrant:bool=False):
+    '''A lock of the real OS thread implementation, even if gevent has monkey patched threading, so it can be shared between
+    job threads and GUI greenlets. Only hold it around short non-blocking sections: a greenlet waiting on it stalls the event loop.
+    reentrant gives an RLock, which the thread holding it can acquire again.'''
+    name = 'RLock' if reentrant else 'allocate_lock'
+    try:
+        from gevent import monkey
+        return monkey.get_original('_thread', name)()
+    except ImportError:
+        return getattr(_thread, name)()
+
+
+class JobCancelled(Exception):
+    '''Raised inside a job by Job.report once the job has been cancelled'''
+
+
+class Job:
+    '''Handle passed to a job function as its first argument, to report progress and check for cancellation'''
+    def __init__(self, job_id:int, name:str):
+        self.job_id = job_id
+        self.name = name
+        self.state = 'queued' # queued -> running -> done | failed | cancelled
+        self.progress = 0. # 0 ... 1
+        self.message = ''
+        self.result = None
+        self.error:str|None = None
+        self.cancel_requested = False
+        self.version = 0 # bumped on every change, so only changed jobs are sent to the frontend
+    def report(self, progress:float|None=None, message:str|None=None):
+        '''Update progress (0 ... 1) and/or the status message. Raises JobCancelled if the job has been cancelled,
+        so calling this regularly is also how a job notices cancellation.'''
+        if progress is not None:
+            self.progress = min(max(float(progress), 0.), 1.)
+        if message is not None:
+            self.message = message
+        self.version += 1
+        if self.cancel_requested:
+            raise JobCancelled()
+    def status(self)->dict:
+        return dict(job_id=self.job_id, name=self.name, state=self.state, progress=self.progress,
+                    message=self.message, result=self.result, error=self.error)
+    @property
+    def finished(self)->bool:
+        return self.state in ('done', 'failed', 'cancelled')
+
+
+class JobRunner:
+    '''Runs func(job, *args, **kwargs) on a pool of worker threads. executor can be any concurrent.futures style
+    executor, e.g. gevent.threadpool.ThreadPoolExecutor, whose threads are real OS threads even under monkey patching.'''
+    def __init__(self, executor=None, max_workers:int=4):
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=max_workers)
+        self.jobs:dict[int,Job] = {}
+        self._ids = itertools.count(1)
+        self._reported:dict[int,int] = {} # job_id -> version last returned by updates()
+    def submit(self, name:str, func, *args, **kwargs)->int:
+        '''Start a job and return its id right away'''
+        job = Job(next(self._ids), name)
+        self.jobs[job.job_id] = job
+        self.executor.submit(self._run, job, func, *args, **kwargs)
+        return job.job_id
+    def _run(self, job:Job, func, *args, **kwargs):
+        if job.cancel_requested:
+            job.state = 'cancelled'
+        else:
+            job.state = 'running'
+            job.version += 1
+            try:
+                job.result = func(job, *args, **kwargs)
+                job.progress = 1.
+                job.state = 'done'
+            except JobCancelled:
+                job.state = 'cancelled'
+            except Exception as e:
+                traceback.print_exc()
+                job.error = f'{type(e).__name__}: {e}'
+                job.state = 'failed'
+        job.version += 1
+    def cancel(self, job_id:int)->bool:
+        '''Ask a job to stop at its next report(). Returns False if it does not exist or has already finished.'''
+        job = self.jobs.get(job_id)
+        if job is None or job.finished:
+            return False
+        job.cancel_requested = True
+        job.version += 1
+        return True
+    def status(self, job_id:int)->dict|None:
+        job = self.jobs.get(job_id)
+        return None if job is None else job.status()
+    def updates(self)->list[dict]:
+        '''Status of every job that changed since the last call. Finished jobs are forgotten once reported.'''
+        res = []
+        for job_id, job in list(self.jobs.items()):
+            version, finished = job.version, job.finished # read finished before status, so the final state is never skipped
+            if self._reported.get(job_id) != version:
+                res.append(job.status())
+                self._reported[job_id] = version
+            if finished and self._reported.get(job_id) == version:
+                del self.jobs[job_id]
+                del self._reported[job_id]
+        return res
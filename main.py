@@ -1,17 +1,26 @@
-import eel, os, pyvisa, json, sys, time, pprint
-from app_base import (AppState, Tab,
+import eel, os, pyvisa, json, sys, time, pprint, base64
+import numpy as np
+from app_base import (_BaseParent, AppState, Tab,
                       DUTSettings,
                       AWGChannelSettings, AWGSettings,
                       OscilloscopeChannelSettings, OscilloscopeSettings,
                       base_class_dict)
 from templatewf import wf_class_dict, CollectionTemplateWF
+from jobs import Job, JobRunner
+from gevent.threadpool import ThreadPoolExecutor
+import DG2000, DHO1000_test
+from sessions import sessions, subnet_candidates
+from acquisition import instrument_lock
+from persistence import StateJournal
+from serialization import pack, unpack
 
 STATEDIR = './.states/'
 state:AppState = None
-try:
-    rm = pyvisa.ResourceManager()
-except:
-    rm = None
+sent_params:dict[int,dict] = {} # py_id -> params last sent to the frontend, so refreshes only send what changed
+job_runner = JobRunner(ThreadPoolExecutor(max_workers=4)) # real threads, so instrument I/O never blocks eel's gevent loop
+awg = None # pyvisa resource of the connected AWG, if any
+journal = StateJournal(STATEDIR) # every edit is appended here, so the state survives a crash
+blobs = journal.blobs # large arrays go to the frontend as references into this store, not as JSON lists
 
 eel.init('web')
 
@@ -21,37 +30,78 @@ def py_update_state(d:dict|None=None):
     '''Update the state in the backend using a dict created by the frontend.'''
     global state
     if d is None:
-        if not os.path.exists(STATEDIR):
-            os.mkdir(STATEDIR)
-        state_files = sorted([f for f in os.listdir(STATEDIR) if os.path.isfile(os.path.join(STATEDIR,f))])
-        if len(state_files) > 0:
-            with open(os.path.join(STATEDIR,state_files[-1])) as f:
-                state = AppState.from_dict(json.load(f))
-        else:
+        state = journal.load() # latest snapshot plus the edits journaled since
+        if state is None:
             state = AppState()
     else:
-        state = AppState.from_dict(d)
-    return state.to_dict()
+        state = AppState.from_dict(unpack(d, blobs))
+        journal.snapshot(state)
+    sent_params.clear() # the frontend is rebuilt from what we return here
+    return pack(state.to_dict(), blobs)
     
 
 @eel.expose
 def py_get_available_resources():
-    if rm is None:
-        return []
-    else:
-        return rm.list_resources()
+    '''Resources found by the last discovery, returned immediately. Use py_refresh_resources to look again.'''
+    return list(sessions.discovered)
+
+def _refresh_resources(job:Job):
+    job.report(0, 'Looking for instruments')
+    try: # probe the whole bench subnet in parallel, the VISA library's own scan only gets a couple of seconds on top
+        return list(sessions.discover(subnet_candidates(), list_resources=True))
+    except pyvisa.Error as e: # no VISA library, just keep what was found before
+        print(e)
+        return list(sessions.discovered)
+
+@eel.expose
+def py_refresh_resources():
+    '''Returns a job id, whose result is the list of resources that answered'''
+    return job_runner.submit('refresh resources', _refresh_resources)
+
+def frontend_params(elem)->dict:
+    return pack({k:e for k,e in elem.to_dict().items() if (k != 'children' and k != '_type')}, blobs)
+
+def _changed(old, new)->bool:
+    try:
+        return bool(old != new)
+    except ValueError: # array-valued parameter, just resend it
+        return True
+
+def frontend_diffs(elem, force:bool=False)->list[tuple[str,dict]]:
+    '''(selector, params) for every element in elem's subtree whose params differ from what was last sent.
+    Only the changed params are included, and elements with no changes are left out entirely.'''
+    diffs = []
+    def diff(e):
+        params = frontend_params(e)
+        last = {} if force else sent_params.get(e.py_id, {})
+        changed = {k:v for k,v in params.items() if k not in last or _changed(last[k], v)}
+        if changed:
+            diffs.append((e.selector, changed))
+        sent_params[e.py_id] = params
+    elem.apply(diff)
+    return diffs
+
+@eel.expose
+def py_forget_sent_params(py_id:int):
+    '''The frontend edited this element locally, so its DOM may differ from what was last sent. The next diff resends all of its params.'''
+    sent_params.pop(int(py_id), None)
 
 @eel.expose
-def py_update_frontend(py_id:int):
+def py_update_frontend(py_id:int, force:bool=False):
     print(py_id)
     elem = state.find_by_py_id(int(py_id))
-    elem.apply( lambda elem: eel.js_update_frontend(elem.selector, {k:e for k,e in elem.to_dict().items() if (k != 'children' and k != '_type')}) )
+    diffs = frontend_diffs(elem, force)
+    if len(diffs) > 0:
+        eel.js_update_frontend_batch(diffs) # one round trip for the whole subtree
 @eel.expose
 def py_update_backend(py_id:int, d:dict):
     print('Updating', py_id, d)
     d.pop('py_id', '')
     d.pop('pyclassname', '')
-    state.find_by_py_id(int(py_id)).update(**d)
+    elem = state.find_by_py_id(int(py_id))
+    elem.update(**d)
+    journal.record(state, 'update', py_id=elem.py_id, params=d)
+    sent_params[elem.py_id] = frontend_params(elem) # these values came from the frontend, so it already has them
 
 @eel.expose
 def py_new_tab(id:str, name:str):
@@ -72,7 +122,8 @@ def py_new_tab(id:str, name:str):
     
     for i in [1,2,3,4]:
         oscope.add_child(OscilloscopeChannelSettings(channel=i))
-    
+
+    journal.record(state, 'add', parent_py_id=state.py_id, element=tab.to_dict())
     return tab.py_id
     tab.apply( lambda elem: eel.js_update_frontend(elem.selector, {k:e for k,e in elem.to_dict().items() if (k != 'children' and k!= '_type')}) )
 
@@ -80,7 +131,9 @@ def py_new_tab(id:str, name:str):
 @eel.expose
 def py_delete_element(py_id:int):
     elem = state.find_by_py_id(py_id)
-    elem.parent.pop( elem.parent._children.index(elem) )
+    elem.parent.pop( elem.parent.index_of(elem) )
+    journal.record(state, 'delete', py_id=elem.py_id)
+    elem.apply( lambda e: sent_params.pop(e.py_id, None) )
 
 
 @eel.expose
@@ -89,6 +142,7 @@ def py_new_wf_block(parent_py_id:int, wfType:str):
     collection = state.find_by_py_id(int(parent_py_id))
     newblock = wf_class_dict[wfType]()
     collection.add_child( newblock )
+    journal.record(state, 'add', parent_py_id=collection.py_id, element=newblock.to_dict())
     return newblock.py_id
 @eel.expose
 def py_move_child_elem(parent_py_id:int, child_py_id:int, shift:int):
@@ -97,15 +151,17 @@ def py_move_child_elem(parent_py_id:int, child_py_id:int, shift:int):
     child = state.find_by_py_id(int(child_py_id))
     idx = collection._children.index(child)
     collection[idx], collection[idx-int(shift)] = collection[idx-int(shift)], collection[idx]
+    journal.record(state, 'move', parent_py_id=collection.py_id, child_py_id=child.py_id, shift=int(shift))
     
 @eel.expose
 def py_get_wf_block_settings(py_id:int):
     block = state.find_by_py_id(py_id)
-    return block.to_dict()
+    return pack(block.to_dict(), blobs)
 @eel.expose
 def py_set_wf_block_settings(py_id:int, blockSettings:dict):
     block = state.find_by_py_id(py_id)
     block.update(**blockSettings)
+    journal.record(state, 'update', py_id=block.py_id, params=blockSettings)
     eel.js_update_frontend(py_id, block.py_id)
     
 
@@ -121,38 +177,127 @@ def py_get_wf_skeleton(awgsettings_py_id):
                     'type':'scatter', 'name':f'Ch{chan.channel+1}'}) #plotly structure
     return data
 
+def _b64_float32(a:np.ndarray)->str:
+    return base64.b64encode(np.ascontiguousarray(a, dtype='<f4').tobytes()).decode('ascii')
+
 @eel.expose
-def py_connect():
-    # Logic to copy CH1 to CH2
-    print('In connect!')
-    time.sleep(5)
-    print('connect done!')
-    return 0
+def py_get_wf_preview(awgsettings_py_id, width_px:int, t_start:float|None=None, t_stop:float|None=None):
+    '''Like py_get_wf_skeleton, but only the window t_start ... t_stop (everything if None), min/max decimated to width_px,
+    and packed as base64 little-endian float32 buffers. Times are sent relative to x0 so float32 keeps its precision when zoomed in.'''
+    awg = state.find_by_py_id(awgsettings_py_id)
+    assert isinstance(awg, AWGSettings), f'Expected a py_id for an AWGSettings, but got {type(awg)}'
+    data = []
+    for chan in awg._children:
+        t,v = chan[0].get_preview(int(width_px), t_start, t_stop)
+        x0 = float(t[0]) if len(t) > 0 else 0.
+        data.append({'x0':x0, 'x':_b64_float32(t-x0), 'y':_b64_float32(v),
+                     'name':f'Ch{chan.channel+1}'})
+    return data
+
+def _forward_job_progress():
+    '''Greenlet sending job progress to the frontend. Jobs run on worker threads and must not call eel themselves.'''
+    while True:
+        for status in job_runner.updates():
+            eel.js_job_progress(status)
+        eel.sleep(0.05)
+
+@eel.expose
+def py_cancel_job(job_id:int):
+    return job_runner.cancel(int(job_id))
 
 @eel.expose
-def py_send_waveform(tabId:str): # returns True if waveform upload was successful. False otherwise.
-    elem = state._children[0]._children[1].selector
-    eel.js_update_frontend(elem, {"sample_rate": 1e9})
+def py_job_status(job_id:int):
+    return job_runner.status(int(job_id))
+
+def _connect(job:Job, resources:dict[str,str]):
+    '''Open (or check and reopen) a session for each instrument, e.g. {'awg': 'TCPIP0::10.97.108.201::INSTR'}'''
+    global awg
+    res = {}
+    for i, (role, resource_name) in enumerate(resources.items()):
+        job.report(i/len(resources), f'Connecting to {role} at {resource_name}')
+        inst = sessions.get(resource_name)
+        with instrument_lock(inst): # an upload or acquisition job may be talking to it right now
+            res[role] = inst.query('*IDN?').strip()
+        if role == 'awg':
+            awg = inst
+    return res
+
+@eel.expose
+def py_connect(resources:dict[str,str]|None=None):
+    '''Returns a job id right away, progress and the *IDN? of each instrument arrive through js_job_progress.
+    Without resources, every open session is checked and reconnected if needed.'''
+    if resources is None:
+        resources = {name:name for name in sessions.sessions}
+    return job_runner.submit('connect', _connect, {role:name.strip() for role,name in resources.items() if name.strip()})
+
+def _send_waveform(job:Job, tab:Tab):
+    '''Sample every AWG channel of tab in blocks and stream them to the AWG (if connected), reporting progress per block.
+    tab must be a copy that the GUI does not edit while this runs. Channels without any waveform blocks are skipped.
+    The AWG's instrument lock is held for each channel's upload, so other jobs never interleave commands with it.'''
+    inst = awg # the connect job may replace the global meanwhile
+    awgsettings = [c for c in tab._children if isinstance(c, AWGSettings)][0]
+    channels = [(chan, chan.sample_rate if chan.sample_rate > 0 else 1e9) for chan in awgsettings._children]
+    channels = [(chan, sr) for chan, sr in channels if len(chan._children) > 0 and chan[0].n_samples(sr) > 0]
+    total = sum(chan[0].n_samples(sr) for chan, sr in channels)
+    done = 0
+    for chan, sr in channels:
+        def chunks(collection=chan[0], sr=sr):
+            nonlocal done
+            for chunk in collection.iter_chunks(sr, DG2000.MAX_BLOCK_POINTS*64):
+                yield chunk
+                done += len(chunk)
+                job.report(done/max(total, 1), f'Ch{chan.channel}: {done}/{total} points')
+        if inst is not None:
+            with instrument_lock(inst):
+                DG2000.send_arb(inst, chan.channel, chunks(), full_scale=float(np.max(np.abs(chan[0].get_skeleton()[1])) or 1))
+        else:
+            for _ in chunks():
+                pass
     return True
 
+def _plan_acquisition(tab:Tab)->dict|None:
+    '''Smallest scope memory depth (and the hscale to go with it) that records the tab's longest AWG waveform at the AWG sample rate,
+    with the oscilloscope channels that have a source connected. None if there is nothing to record.'''
+    awgsettings = [c for c in tab._children if isinstance(c, AWGSettings)][0]
+    oscope = [c for c in tab._children if isinstance(c, OscilloscopeSettings)][0]
+    chans = [chan for chan in awgsettings._children if len(chan._children) > 0 and chan[0].duration() > 0]
+    if len(chans) == 0:
+        return None
+    duration = max(chan[0].duration() for chan in chans)
+    sample_rate = max(chan.sample_rate if chan.sample_rate > 0 else 1e9 for chan in chans)
+    n_channels = min(max(sum(1 for ch in oscope._children if ch.source != 'No Source'), 1), 4)
+    return DHO1000_test.plan_acquisition(duration, sample_rate, n_channels)
+
 @eel.expose
-def py_trigger():
+def py_send_waveform(tabId:str): # returns a job id. The job's result is True if waveform upload was successful.
+    tab = [t for t in state._children if t.id == tabId][0]
+    plan = _plan_acquisition(tab)
+    if plan is not None: # show the sample rate the scope will really use
+        oscope = [c for c in tab._children if isinstance(c, OscilloscopeSettings)][0]
+        oscope.update(sample_rate=plan['sample_rate'])
+        journal.record(state, 'update', py_id=oscope.py_id, params=dict(sample_rate=plan['sample_rate']))
+        py_update_frontend(oscope.py_id)
+    tab = _BaseParent.from_dict(tab.to_dict()) # snapshot, GUI callbacks may edit the tab while the job samples it
+    return job_runner.submit(f'send waveform {tabId}', _send_waveform, tab)
+
+def _trigger(job:Job):
     print('In trigger!')
     return 0
 
+@eel.expose
+def py_trigger():
+    return job_runner.submit('trigger', _trigger)
+
 def on_close(*args, **kwargs):
-    d = state.to_dict()
+    sessions.close_all()
     print('Application state upon closing:')
-    pprint.pprint(d)
+    pprint.pprint(state.to_dict())
 
-    ofname = f'{STATEDIR}/app-state-{time.time()}.json'
-    if not os.path.exists(STATEDIR):
-        os.mkdir(STATEDIR)
-    # with open(ofname, 'w') as f:
-    #     json.dump(d, f, indent=4)
-    
-    # print(f'State saved to {ofname}')
+    journal.snapshot(state) # compact everything journaled this session into one snapshot
+    journal.close()
+    print(f'State saved to {STATEDIR}')
     sys.exit()
 
 
+eel.spawn(_forward_job_progress)
 eel.start('main.html', mode='edge', close_callback=on_close)
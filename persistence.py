@@ -0,0 +1,130 @@
+# persistence.py
+# Crash-safe autosave of the AppState: every edit is appended to a journal, and the journal is periodically
+# compacted into a snapshot. index.json names the current snapshot and journal, so loading never lists the directory.
+# Large arrays are kept out of the JSON, as .npy blobs in root/blobs/ referenced by their hash.
+import os, json
+from app_base import AppState, _BaseParent
+from serialization import BlobStore, pack, unpack
+
+INDEX_FILE = 'index.json'
+
+def _write_atomic(path:str, text:str):
+    '''Write to a temporary file and rename it over path, so path always holds either the old or the new text'''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def apply_entry(state:AppState, entry:dict):
+    '''Redo one journaled edit on state'''
+    op = entry['op']
+    if op == 'update':
+        state.find_by_py_id(entry['py_id']).update(**entry['params'])
+    elif op == 'add':
+        state.find_by_py_id(entry['parent_py_id']).add_child(_BaseParent.from_dict(entry['element']))
+    elif op == 'delete':
+        elem = state.find_by_py_id(entry['py_id'])
+        elem.parent.pop(elem.parent.index_of(elem))
+    elif op == 'move':
+        parent = state.find_by_py_id(entry['parent_py_id'])
+        idx = parent.index_of(state.find_by_py_id(entry['child_py_id']))
+        parent[idx], parent[idx-entry['shift']] = parent[idx-entry['shift']], parent[idx]
+    else:
+        raise ValueError(f'Unknown journal operation {op}')
+
+
+class StateJournal:
+    '''Append-only journal of AppState edits in root. Each record() costs one short line, whatever the size of the state.
+    After compact_every entries, the next record() writes a compact snapshot and starts a fresh journal.'''
+    def __init__(self, root:str='./.states/', compact_every:int=500):
+        self.root = root
+        self.compact_every = compact_every
+        self.seq = 0 # number of the current snapshot/journal pair, 0 before the first load or snapshot
+        self.n_entries = 0 # entries in the current journal
+        self._journal = None # open file handle of the current journal
+        self.blobs = BlobStore(os.path.join(root, 'blobs'))
+
+    def _path(self, fname:str)->str:
+        return os.path.join(self.root, fname)
+
+    def _read_index(self)->dict|None:
+        if not os.path.exists(self._path(INDEX_FILE)):
+            return None
+        with open(self._path(INDEX_FILE)) as f:
+            return json.load(f)
+
+    def _legacy_state(self)->dict|None:
+        '''Newest full state dump from before the journal existed, if any'''
+        state_files = sorted(f for f in os.listdir(self.root) if f.startswith('app-state-') and f.endswith('.json'))
+        if len(state_files) == 0:
+            return None
+        with open(self._path(state_files[-1])) as f:
+            return json.load(f)
+
+    def load(self)->AppState|None:
+        '''The latest snapshot with its journal replayed on top, or None if nothing was saved yet.
+        A line torn by a crash at the end of the journal is skipped.'''
+        os.makedirs(self.root, exist_ok=True)
+        index = self._read_index()
+        if index is None:
+            d = self._legacy_state()
+            if d is None:
+                return None
+            state = AppState.from_dict(d)
+            self.snapshot(state) # start journaling from here
+            return state
+        self.seq = index['seq']
+        with open(self._path(index['snapshot'])) as f:
+            state = AppState.from_dict(unpack(json.load(f), self.blobs))
+        self.n_entries = 0
+        torn = False
+        if os.path.exists(self._path(index['journal'])):
+            with open(self._path(index['journal'])) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        print(f'Skipping unreadable journal entry {line!r}')
+                        torn = True
+                        continue
+                    apply_entry(state, unpack(entry, self.blobs))
+                    self.n_entries += 1
+        if torn: # start a clean journal, rather than appending after a partial line
+            self.snapshot(state)
+        return state
+
+    def record(self, state:AppState, op:str, **entry):
+        '''Append one edit (already applied to state) to the journal, e.g. record(state, 'delete', py_id=3).
+        Flushed to disk before returning, so it survives a crash right after.'''
+        if self.seq == 0 or self.n_entries >= self.compact_every: # no snapshot yet to journal against, or time to compact
+            self.snapshot(state)
+            return
+        if self._journal is None:
+            self._journal = open(self._path(f'journal-{self.seq}.jsonl'), 'a')
+        self._journal.write(json.dumps(pack(dict(op=op, **entry), self.blobs)) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self.n_entries += 1
+
+    def snapshot(self, state:AppState):
+        '''Write the whole state as a new snapshot with an empty journal, point the index at them and delete the old pair'''
+        os.makedirs(self.root, exist_ok=True)
+        old = self._read_index()
+        self.close()
+        self.seq = (old['seq'] if old is not None else self.seq) + 1
+        snapshot, journal = f'snapshot-{self.seq}.json', f'journal-{self.seq}.jsonl'
+        _write_atomic(self._path(snapshot), json.dumps(pack(state.to_dict(), self.blobs)))
+        _write_atomic(self._path(journal), '')
+        _write_atomic(self._path(INDEX_FILE), json.dumps(dict(seq=self.seq, snapshot=snapshot, journal=journal)))
+        self.n_entries = 0
+        if old is not None: # only once the index points at the new pair
+            for fname in (old['snapshot'], old['journal']):
+                if os.path.exists(self._path(fname)):
+                    os.remove(self._path(fname))
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -1,25 +1,18 @@
-import pyvisa
-from app_base import DeviceSettings
+import time
+from sessions import sessions, subnet_candidates
 
-# Create a Resource Manager
-rm = pyvisa.ResourceManager()
-
-# List all available resources
-resources = rm.list_resources()
-print(resources)
-resources = ('TCPIP0::10.97.108.205::INSTR','TCPIP0::10.97.108.206::INSTR',)
+# Probe the bench subnet in parallel, plus whatever the VISA library lists itself.
+# Instruments that answer stay connected in sessions, and are remembered for the next discovery.
+t0 = time.perf_counter()
+resources = sessions.discover(subnet_candidates('10.97.108'), list_resources=True)
+print(f'Scan took {time.perf_counter()-t0:.2f} s')
 
 # Print the available resources and additional information
 if resources:
     print("Available connections and device information:")
-    for resource in resources:
+    for resource, idn in resources.items():
         print(f"Resource: {resource}")
-        try:
-            instrument = rm.open_resource(resource)
-            print(f"  Manufacturer: {instrument.query('*IDN?')}")
-            instrument.close()
-        except Exception as e:
-            print(f"  Could not retrieve information: {e}")
+        print(f"  Manufacturer: {idn}")
 else:
     print("No available connections found.")
-
+sessions.close_all()
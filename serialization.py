@@ -0,0 +1,84 @@
+# serialization.py
+# JSON-safe dicts from to_dict() trees that may hold large numpy arrays (e.g. ArbitraryTemplateWF.values).
+# Large arrays are swapped for small references: a content hash of a .npy blob in a BlobStore, or base64 of the raw bytes.
+import os, base64, hashlib, weakref
+import numpy as np
+
+ARRAY_KEY = '__ndarray__' # marks a packed array, {'__ndarray__': digest, 'dtype': ..., 'shape': ..., ['b64': ...]}
+MIN_PACKED_SIZE = 1024 # smaller arrays are written out as plain lists
+
+
+def array_digest(a:np.ndarray)->str:
+    a = np.ascontiguousarray(a)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{a.dtype.str}{a.shape}'.encode())
+    h.update(a.data)
+    return h.hexdigest()
+
+
+class BlobStore:
+    '''Content-addressed .npy files, root/{digest}.npy. A blob is only written if it does not exist yet,
+    and is loaded back as a read-only memory map, so neither saving an unchanged array nor loading one copies it.
+    Blobs are never deleted automatically, since old snapshots and the frontend may still refer to them.'''
+    def __init__(self, root:str):
+        self.root = root
+        self._digests:dict[int, tuple[weakref.ref, str]] = {} # id -> (array, digest) for read-only arrays already hashed
+    def _path(self, digest:str)->str:
+        return os.path.join(self.root, f'{digest}.npy')
+    def digest(self, a:np.ndarray)->str:
+        '''Hash of a. Remembered for read-only arrays, which cannot change, so they are hashed only once.'''
+        known = self._digests.get(id(a))
+        if known is not None and known[0]() is a:
+            return known[1]
+        digest = array_digest(a)
+        if not a.flags.writeable:
+            self._digests[id(a)] = (weakref.ref(a), digest)
+        return digest
+    def put(self, a:np.ndarray)->str:
+        digest = self.digest(a)
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(self.root, exist_ok=True)
+            np.save(path + '.tmp.npy', a)
+            os.replace(path + '.tmp.npy', path) # a blob is either complete or missing
+        return digest
+    def get(self, digest:str)->np.ndarray:
+        a = np.load(self._path(digest), mmap_mode='r')
+        self._digests[id(a)] = (weakref.ref(a), digest)
+        return a
+
+
+def pack(obj, store:BlobStore|None=None, min_size:int=MIN_PACKED_SIZE):
+    '''Copy of a to_dict() tree with every array replaced by something JSON can hold. Arrays of at least min_size
+    elements go to store and are referenced by digest, or are inlined as base64 if there is no store.'''
+    if isinstance(obj, dict):
+        return {k:pack(v, store, min_size) for k,v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [pack(v, store, min_size) for v in obj]
+    elif isinstance(obj, np.ndarray):
+        if obj.size < min_size:
+            return obj.tolist()
+        ref = {'dtype':obj.dtype.str, 'shape':list(obj.shape)}
+        if store is not None:
+            ref[ARRAY_KEY] = store.put(obj)
+        else:
+            ref[ARRAY_KEY] = ''
+            ref['b64'] = base64.b64encode(np.ascontiguousarray(obj).data).decode('ascii')
+        return ref
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+def unpack(obj, store:BlobStore|None=None):
+    '''Inverse of pack. Arrays from a store come back as read-only memory maps.'''
+    if isinstance(obj, dict):
+        if ARRAY_KEY in obj:
+            if 'b64' in obj:
+                a = np.frombuffer(base64.b64decode(obj['b64']), dtype=np.dtype(obj['dtype']))
+                return a.reshape(obj['shape'])
+            assert store is not None, f'Array {obj[ARRAY_KEY]} is stored out of band, but no BlobStore was given'
+            return store.get(obj[ARRAY_KEY])
+        return {k:unpack(v, store) for k,v in obj.items()}
+    elif isinstance(obj, list):
+        return [unpack(v, store) for v in obj]
+    return obj
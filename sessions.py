@@ -0,0 +1,189 @@
+# sessions.py
+# Persistent VISA sessions, one per resource, plus fast parallel discovery of instruments on the bench network.
+import os, json, socket, time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import pyvisa
+from jobs import os_lock
+from acquisition import resource_lock
+
+KNOWN_RESOURCES = ('TCPIP0::10.97.108.205::INSTR', 'TCPIP0::10.97.108.206::INSTR') # bench scopes, always probed
+OPEN_OPTIONS = dict(timeout=10000, # ms. Long enough for a full chunk of waveform data
+                    chunk_size=2**20) # bytes per read. The 20 kB default makes waveform transfers needlessly slow
+SOCKET_OPTIONS = dict(read_termination='\n', write_termination='\n') # raw ::SOCKET resources have no message framing of their own
+PROBE_PORTS = dict(INSTR=111, HISLIP=4880, SOCKET=None) # VXI-11 instruments answer on the portmapper, HiSLIP on 4880. SOCKET resources carry their own port
+BENCH_SUBNET = '10.97.108' # /24 the bench instruments live on
+
+def _host_port(resource_name:str)->tuple[str,int]|None:
+    '''(host, port) to probe for a TCPIP resource string, None for other interfaces'''
+    parts = resource_name.split('::')
+    if not parts[0].upper().startswith('TCPIP') or len(parts) < 3:
+        return None
+    if parts[-1].upper() == 'SOCKET':
+        return parts[1], int(parts[2])
+    if len(parts) > 3 and parts[2].lower().startswith('hislip'): # TCPIP::host::hislip0::INSTR
+        return parts[1], PROBE_PORTS['HISLIP']
+    return parts[1], PROBE_PORTS['INSTR']
+
+def tcp_reachable(resource_name:str, timeout:float=0.3)->bool:
+    '''Whether anything accepts a TCP connection where resource_name lives. Much faster than letting VISA time out.
+    Non-TCPIP resources (USB, GPIB, ...) are assumed reachable.'''
+    hp = _host_port(resource_name)
+    if hp is None:
+        return True
+    try:
+        with socket.create_connection(hp, timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+def subnet_candidates(prefix:str=BENCH_SUBNET, hosts=range(1,255))->list[str]:
+    '''VXI-11 resource strings for every host of a /24 subnet, for discover()'''
+    return [f'TCPIP0::{prefix}.{i}::INSTR' for i in hosts]
+
+
+class SessionManager:
+    '''Keeps one open session per resource string and hands it out again on every get(). Sessions that fail
+    a health check (a cheap *OPC? query) are reopened. Discovery results are cached in cache_file,
+    so the list of instruments is available immediately on the next start.'''
+    def __init__(self, rm:pyvisa.ResourceManager|None=None, cache_file:str|None='./.states/resources.json',
+                 health_interval:float=5.):
+        self._rm = rm
+        self.sessions:dict[str,pyvisa.resources.MessageBasedResource] = {}
+        self._last_ok:dict[str,float] = {} # resource name -> time of the last successful use or health check
+        self._locks:dict[str,object] = {} # resource name -> os_lock(), sessions are opened from job threads and the GUI
+        self._locks_lock = os_lock()
+        self.health_interval = health_interval # s. Sessions used more recently than this are not checked again
+        self.cache_file = cache_file
+        self.discovered:dict[str,str] = self._load_cache() # resource name -> *IDN? response
+    @property
+    def rm(self)->pyvisa.ResourceManager:
+        if self._rm is None:
+            self._rm = pyvisa.ResourceManager()
+        return self._rm
+
+    def _lock(self, resource_name:str):
+        with self._locks_lock:
+            if resource_name not in self._locks:
+                self._locks[resource_name] = os_lock()
+            return self._locks[resource_name]
+
+    def _open(self, resource_name:str, **options):
+        kwargs = dict(OPEN_OPTIONS)
+        if resource_name.upper().endswith('::SOCKET'):
+            kwargs.update(SOCKET_OPTIONS)
+        kwargs.update(options)
+        chunk_size = kwargs.pop('chunk_size')
+        inst = self.rm.open_resource(resource_name, **kwargs)
+        inst.chunk_size = chunk_size
+        return inst
+
+    def is_alive(self, resource_name:str, timeout:int=1000)->bool:
+        '''Cheap round trip to an open session, with a short timeout. An instrument that another thread is talking to
+        (holding its acquisition.resource_lock) is busy, not dead, and is reported alive without interrupting it.'''
+        inst = self.sessions.get(resource_name)
+        if inst is None:
+            return False
+        lock = resource_lock(resource_name)
+        if not lock.acquire(blocking=False):
+            return True
+        try:
+            old_timeout, inst.timeout = inst.timeout, timeout
+            try:
+                inst.query('*OPC?')
+            finally:
+                inst.timeout = old_timeout
+        except Exception: # closed session, dropped connection, timeout, ...
+            return False
+        finally:
+            lock.release()
+        self._last_ok[resource_name] = time.perf_counter()
+        return True
+
+    def get(self, resource_name:str, **options):
+        '''The open session for resource_name, opening it or reconnecting it if it stopped answering.
+        options are passed on to open_resource when a new session is opened.'''
+        with self._lock(resource_name):
+            inst = self.sessions.get(resource_name)
+            if inst is not None and time.perf_counter() - self._last_ok.get(resource_name, 0) > self.health_interval:
+                if not self.is_alive(resource_name):
+                    print(f'{resource_name} stopped responding, reconnecting')
+                    self._close(resource_name)
+                    inst = None
+            if inst is None:
+                inst = self._open(resource_name, **options)
+                self.sessions[resource_name] = inst
+            self._last_ok[resource_name] = time.perf_counter()
+            return inst
+
+    def _close(self, resource_name:str):
+        inst = self.sessions.pop(resource_name, None)
+        self._last_ok.pop(resource_name, None)
+        if inst is not None:
+            try:
+                inst.close()
+            except Exception:
+                pass
+
+    def close(self, resource_name:str):
+        with self._lock(resource_name):
+            self._close(resource_name)
+
+    def close_all(self):
+        for resource_name in list(self.sessions):
+            self.close(resource_name)
+
+    def _load_cache(self)->dict[str,str]:
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return {}
+        with open(self.cache_file) as f:
+            return json.load(f)
+
+    def _save_cache(self):
+        if self.cache_file is None:
+            return
+        os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+        with open(self.cache_file, 'w') as f:
+            json.dump(self.discovered, f, indent=4)
+
+    def _probe(self, resource_name:str, timeout:float)->str|None:
+        '''*IDN? of resource_name, or None if nothing answers within about timeout seconds'''
+        if resource_name not in self.sessions and not tcp_reachable(resource_name, timeout):
+            return None
+        try:
+            inst = self.get(resource_name, open_timeout=int(timeout*1000))
+            old_timeout, inst.timeout = inst.timeout, int(timeout*1000)
+            try:
+                return inst.query('*IDN?').strip()
+            finally:
+                inst.timeout = old_timeout
+        except Exception:
+            self.close(resource_name)
+            return None
+
+    def discover(self, candidates=(), list_resources:bool=False, timeout:float=0.5, max_workers:int=64,
+                 list_timeout:float|None=2.)->dict[str,str]:
+        '''Probe candidate resource strings in parallel and return {resource name: *IDN?} for those that answer.
+        The previously discovered resources and KNOWN_RESOURCES are always probed too. list_resources adds
+        the VISA library's own (slow, serial) scan alongside, whose results are only used if it finishes within
+        list_timeout seconds of the probes (None waits for it). The result is cached for the next start.'''
+        candidates = list(dict.fromkeys([*candidates, *KNOWN_RESOURCES, *self.discovered]))
+        listed = None
+        if list_resources: # on its own thread, which is left running if it takes too long
+            lister = ThreadPoolExecutor(max_workers=1)
+            listed = lister.submit(self.rm.list_resources)
+            lister.shutdown(wait=False)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            idns = dict(zip(candidates, pool.map(lambda r: self._probe(r, timeout), candidates)))
+            if listed is not None:
+                try:
+                    extra = [r for r in listed.result(timeout=list_timeout) if r not in idns]
+                except TimeoutError:
+                    print(f'VISA resource listing took longer than {list_timeout} s, using the probed candidates only')
+                    extra = []
+                idns.update(zip(extra, pool.map(lambda r: self._probe(r, timeout), extra)))
+        self.discovered = {r:idn for r,idn in idns.items() if idn is not None}
+        self._save_cache()
+        return self.discovered
+
+
+sessions = SessionManager() # shared by the GUI and scripts, so every instrument is only connected once per process
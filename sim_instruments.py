@@ -0,0 +1,240 @@
+# sim_instruments.py
+# Simulated instruments speaking SCPI over a raw TCP socket, for benchmarking and trying things out without the bench.
+# SimulatedDHO1000 covers what DHO1000_test.py sends (hconfig, vconfig, force_trigger, get_data), SimulatedDG2000 arbitrary waveform upload.
+# Connect with pyvisa-py, e.g.
+#     rm = pyvisa.ResourceManager('@py')
+#     oscope = rm.open_resource(f'TCPIP::127.0.0.1::{sim.port}::SOCKET', read_termination='\n', write_termination='\n')
+import socket, threading, time
+import numpy as np
+
+
+class SimulatedInstrument:
+    '''Threaded SCPI socket server. Messages are newline terminated and may hold several ;-separated commands.
+    Subclasses handle individual commands in handle(). Only the short command forms are understood.
+    latency is added once per query message, bandwidth (bytes/s, None for unlimited) throttles both directions.'''
+    idn = 'SIMULATED,INSTRUMENT,0,0'
+    def __init__(self, port:int=0, latency:float=0., bandwidth:float|None=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', port))
+        self.port = self._sock.getsockname()[1]
+        self._thread = None
+        self._running = False
+        self.lock = threading.Lock() # one command at a time, like a real instrument
+        self.errors:list[str] = [] # SCPI error queue, read with :syst:err?
+        self.reset()
+    @property
+    def resource_name(self)->str:
+        return f'TCPIP::127.0.0.1::{self.port}::SOCKET'
+    def reset(self):
+        pass
+    def start(self):
+        self._sock.listen()
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+    def stop(self):
+        self._running = False
+        self._sock.close()
+    def __enter__(self):
+        return self.start()
+    def __exit__(self, *args):
+        self.stop()
+    def _serve(self):
+        while self._running:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+    def _handle_connection(self, conn:socket.socket):
+        buf = b''
+        with conn:
+            while self._running:
+                try:
+                    data = conn.recv(65536)
+                except OSError:
+                    return
+                if not data:
+                    return
+                if self.bandwidth is not None:
+                    time.sleep(len(data)/self.bandwidth)
+                buf += data
+                while True:
+                    end = self._message_end(buf)
+                    if end is None:
+                        break
+                    msg, buf = buf[:end], buf[end+1:]
+                    response = self.process(msg.decode('latin-1'))
+                    if response is not None:
+                        self._send(conn, response)
+    @staticmethod
+    def _message_end(buf:bytes)->int|None:
+        '''Index of the newline ending the first complete message in buf, skipping over the contents of
+        definite-length binary blocks (#<n><length><data>), whose data may contain newlines'''
+        i = 0
+        while True:
+            nl, block = buf.find(b'\n', i), buf.find(b'#', i)
+            if nl < 0:
+                return None
+            if block < 0 or block > nl or block+1 >= len(buf) or not buf[block+1:block+2].isdigit():
+                return nl
+            n = int(buf[block+1:block+2])
+            if len(buf) < block+2+n:
+                return None # the length field has not arrived yet
+            i = block + 2 + n + int(buf[block+2:block+2+n] or 0)
+            if i > len(buf):
+                return None
+    def _send(self, conn:socket.socket, response:bytes):
+        time.sleep(self.latency)
+        if self.bandwidth is None:
+            conn.sendall(response)
+            return
+        step = max(int(self.bandwidth*0.01), 1) # ~10 ms worth of bytes at a time
+        for i in range(0, len(response), step):
+            t0 = time.perf_counter()
+            conn.sendall(response[i:i+step])
+            time.sleep(max(len(response[i:i+step])/self.bandwidth - (time.perf_counter()-t0), 0))
+    def process(self, msg:str)->bytes|None:
+        '''Run every command in a message. Returns the ;-joined responses of its queries, or None if there were none.'''
+        responses = []
+        with self.lock:
+            for cmd in self._split(msg):
+                header, _, arg = cmd.partition(' ')
+                res = self.handle(header.lower(), arg.lstrip())
+                if res is not None:
+                    responses.append(res)
+        if len(responses) == 0:
+            return None
+        return b';'.join(r if isinstance(r, bytes) else str(r).encode() for r in responses) + b'\n'
+    @staticmethod
+    def _split(msg:str)->list[str]:
+        '''Commands of a ;-separated message, with surrounding whitespace removed. Binary blocks are kept whole,
+        even if their data holds ; or whitespace.'''
+        cmds, start, i, protected = [], 0, 0, 0 # protected: end of the last binary block, never stripped
+        while i <= len(msg):
+            if i < len(msg) and msg[i] == '#' and msg[i+1:i+2].isdigit():
+                n = int(msg[i+1])
+                i = protected = i + 2 + n + int(msg[i+2:i+2+n] or 0)
+                continue
+            if i == len(msg) or msg[i] == ';':
+                cmd = msg[start:protected] + msg[max(start, protected):i].rstrip()
+                if cmd.strip():
+                    cmds.append(cmd.lstrip())
+                start = i + 1
+            i += 1
+        return cmds
+    def handle(self, header:str, arg:str):
+        '''Handle one command. Return the response for queries, None otherwise.'''
+        if header == '*idn?':
+            return self.idn
+        elif header == '*opc?':
+            return '1'
+        elif header == '*rst':
+            self.reset()
+        elif header == '*cls':
+            self.errors.clear()
+        elif header == ':syst:err?':
+            return self.errors.pop(0) if self.errors else '0,"No error"'
+        return None
+
+
+class SimulatedDHO1000(SimulatedInstrument):
+    '''Simulated Rigol DHO1000 series oscilloscope. Implements the commands used in DHO1000_test.py.
+    Captured data is a noisy triangle wave per channel, generated once per memory depth.'''
+    idn = 'RIGOL TECHNOLOGIES,DHO1074,SIM0000001,00.01.00'
+    max_sample_rate = 2e9 # Sa/s, shared between active channels
+    def reset(self):
+        self.settings = {':tim:main:scal':1e-6, ':tim:main:offs':0., ':tim:roll':0, ':acq:mdep':1e6,
+                         ':trig:edge:sour':'EXT', ':trig:edge:lev':0.,
+                         ':wav:sour':'CHAN1', ':wav:mode':'NORM', ':wav:form':'BYTE', ':wav:start':1, ':wav:stop':1000}
+        for ch in range(1,5):
+            self.settings.update({f':chan{ch}:disp':0, f':chan{ch}:scal':1., f':chan{ch}:offs':0.})
+        self.status = 'STOP'
+        self._done_at = 0.
+        self._data = {}
+    def sample_rate(self)->float:
+        n_active = max(sum(int(self.settings[f':chan{ch}:disp']) for ch in range(1,5)), 1)
+        n_active = 1 if n_active == 1 else (2 if n_active == 2 else 4)
+        return min(self.max_sample_rate/n_active, self.settings[':acq:mdep']/(10*self.settings[':tim:main:scal']))
+    def _capture(self, ch:int)->np.ndarray:
+        pts = int(self.settings[':acq:mdep'])
+        if (ch, pts) not in self._data:
+            rng = np.random.default_rng(ch)
+            tri = np.abs((np.arange(pts)*(8*ch/pts)) % 2 - 1) # ch*4 triangle periods
+            self._data[(ch, pts)] = (32768 + 20000*(tri-0.5) + 50*rng.standard_normal(pts)).astype('<u2')
+        return self._data[(ch, pts)]
+    def handle(self, header:str, arg:str):
+        if header == ':single':
+            self.status = 'WAIT'
+        elif header == ':stop':
+            self.status = 'STOP'
+        elif header == ':tforce':
+            if self.status == 'WAIT':
+                self.status = 'TD'
+                self._done_at = time.perf_counter() + self.settings[':acq:mdep']/self.sample_rate()
+        elif header == ':trig:stat?':
+            if self.status == 'TD' and time.perf_counter() >= self._done_at:
+                self.status = 'STOP'
+            return self.status
+        elif header == ':acq:srat?':
+            return f'{self.sample_rate():.6e}'
+        elif header == ':wav:pre?':
+            return self._preamble()
+        elif header == ':wav:data?':
+            return self._waveform_block()
+        elif header.endswith('?') and header[:-1] in self.settings:
+            return self.settings[header[:-1]]
+        elif header in (':wav:start', ':wav:stop'):
+            start, stop = (int(float(arg)) if header == h else self.settings[h] for h in (':wav:start', ':wav:stop'))
+            if 1 <= start <= stop: # like the scope, reject a window that would be empty
+                self.settings[header] = int(float(arg))
+            else:
+                self.errors.append(f'-222,"Data out of range; {header} {arg}"')
+        elif header in self.settings:
+            self.settings[header] = type(self.settings[header])(float(arg)) if not isinstance(self.settings[header], str) else arg.upper()
+        else:
+            return super().handle(header, arg)
+    def _word(self)->bool:
+        return self.settings[':wav:form'].startswith('WORD')
+    def _preamble(self)->str:
+        ch = int(self.settings[':wav:sour'][-1])
+        yinc = self.settings[f':chan{ch}:scal']*8/(65536 if self._word() else 256)
+        yref = 32768 if self._word() else 128
+        points = int(self.settings[':wav:stop']) - int(self.settings[':wav:start']) + 1
+        xinc = 1/self.sample_rate()
+        xor = -self.settings[':acq:mdep']*xinc/2 + self.settings[':tim:main:offs']
+        return f'{int(self._word())},2,{points},1,{xinc:e},{xor:e},0,{yinc:e},0,{yref}'
+    def _waveform_block(self)->bytes:
+        ch = int(self.settings[':wav:sour'][-1])
+        data = self._capture(ch)[int(self.settings[':wav:start'])-1:int(self.settings[':wav:stop'])]
+        raw = data.tobytes() if self._word() else (data >> 8).astype(np.uint8).tobytes()
+        return f'#9{len(raw):09d}'.encode() + raw
+
+
+class SimulatedDG2000(SimulatedInstrument):
+    '''Simulated Rigol DG2000 series AWG. Accepts the arbitrary waveform packets sent by DG2000.send_arb
+    (:sour<n>:trac:data:dac16 volatile,CON|END,#<block>) and keeps each channel's uploaded DAC codes.'''
+    idn = 'Rigol Technologies,DG2102,SIM0000002,00.01.00'
+    def reset(self):
+        self.settings = {f':sour{ch}:func':'SIN' for ch in (1,2)}
+        self.waveforms:dict[int,np.ndarray] = {} # channel -> DAC codes of the last complete upload
+        self._pending:dict[int,list[np.ndarray]] = {} # channel -> packets of an upload still in progress
+    def handle(self, header:str, arg:str):
+        if header.startswith(':sour') and header.endswith(':trac:data:dac16'):
+            ch = int(header[len(':sour')])
+            _, flag, block = arg.split(',', 2)
+            n = int(block[1])
+            data = block[2+n:2+n+int(block[2:2+n])].encode('latin-1')
+            self._pending.setdefault(ch, []).append(np.frombuffer(data, dtype='<u2'))
+            if flag.upper() == 'END':
+                self.waveforms[ch] = np.concatenate(self._pending.pop(ch))
+        elif header.endswith('?') and header[:-1] in self.settings:
+            return self.settings[header[:-1]]
+        elif header in self.settings:
+            self.settings[header] = arg.upper()
+        else:
+            return super().handle(header, arg)
@@ -0,0 +1,164 @@
+# sweep.py
+# Parameter sweeps over the waveform blocks of a Tab, run as a three stage pipeline:
+#     synthesize point k+1  |  upload and acquire point k  |  analyze and persist point k-1
+# Each stage has its own worker thread, so a sweep step takes as long as its slowest stage rather than the sum of all three.
+# Every finished point is appended to results.jsonl, and a restarted sweep skips the points already in there.
+import os, json, time, itertools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from app_base import Tab, AWGSettings, TemplateWF, _BaseParent
+from templatewf import CollectionTemplateWF
+from data import CaptureStore
+from serialization import pack
+
+STAGES = ('synthesize', 'acquire', 'analyze')
+
+def parameter_grid(**axes)->list[dict]:
+    '''Every combination of the given values, e.g. parameter_grid(**{'PUNDTemplateWF.amplitude': [1, 2], '12.rise_time': [1e-6, 2e-6]}).
+    Keys are '<target>.<field>', where target is a block class name (every block of that class) or a block py_id.'''
+    keys = list(axes)
+    return [dict(zip(keys, values)) for values in itertools.product(*(axes[k] for k in keys))]
+
+def configure(tab:Tab, point:dict)->Tab:
+    '''Copy of tab with the parameters of one grid point applied to its waveform blocks. The original tab is not touched,
+    so the next point can be set up while the current one is still being measured.'''
+    tab = _BaseParent.from_dict(tab.to_dict())
+    blocks = []
+    tab.apply(lambda e: blocks.append(e) if isinstance(e, TemplateWF) and not isinstance(e, CollectionTemplateWF) else None)
+    for key, value in point.items():
+        target, field = key.rsplit('.', 1)
+        hits = [b for b in blocks if b.__class__.__name__ == target or str(b.py_id) == target]
+        assert len(hits) > 0, f'No waveform block matches {target} in {key}'
+        for block in hits:
+            block.update(**{field:value})
+    return tab
+
+def synthesize(tab:Tab, default_sample_rate:float=1e9)->dict[int,np.ndarray]:
+    '''Sampled waveform of every AWG channel of tab, {channel: volts}'''
+    awg = [c for c in tab._children if isinstance(c, AWGSettings)][0]
+    return {chan.channel: chan[0].sample_wf(chan.sample_rate if chan.sample_rate > 0 else default_sample_rate)
+            for chan in awg._children}
+
+
+class Sweep:
+    '''Runs acquire(point, tab, waveforms) -> capture and analyze(point, tab, capture) -> result for every point of a grid.
+    acquire does the instrument I/O (upload the waveforms, trigger, read back); analyze turns a capture into a
+    JSON-serializable result. Results, parameters and per-stage timing are appended to root/results.jsonl as each
+    point finishes, and captures are kept in a CaptureStore under root if store_captures is set.'''
+    def __init__(self, tab:Tab, grid:list[dict], acquire, analyze, root:str, store_captures:bool=False, progress=None):
+        self.tab = tab
+        self.grid = grid
+        self.acquire = acquire
+        self.analyze = analyze
+        self.root = root
+        self.store = CaptureStore(os.path.join(root, 'captures')) if store_captures else None
+        self.progress = progress # called as progress(n_done, n_total, result_line) after each point
+        self.timing:dict[str,list[float]] = {stage:[] for stage in STAGES}
+        os.makedirs(root, exist_ok=True)
+        self._check_grid()
+
+    def _path(self, fname:str)->str:
+        return os.path.join(self.root, fname)
+
+    def _check_grid(self):
+        '''Store the grid with the sweep, or make sure a resumed sweep is still running the same grid'''
+        grid = json.loads(json.dumps(pack(self.grid)))
+        if os.path.exists(self._path('sweep.json')):
+            with open(self._path('sweep.json')) as f:
+                assert json.load(f)['grid'] == grid, f'{self.root} holds a different sweep, use another directory'
+        else:
+            with open(self._path('sweep.json'), 'w') as f:
+                json.dump(dict(grid=grid, tab=pack(self.tab.to_dict())), f)
+
+    def done(self)->dict[int,dict]:
+        '''Result lines of the points finished so far, by grid index. A line torn by a crash is ignored.'''
+        res = {}
+        if os.path.exists(self._path('results.jsonl')):
+            with open(self._path('results.jsonl')) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    res[entry['index']] = entry
+        return res
+
+    def _timed(self, func, *args):
+        t0 = time.perf_counter()
+        res = func(*args)
+        return res, time.perf_counter() - t0
+
+    def _synthesize(self, i:int):
+        tab = configure(self.tab, self.grid[i])
+        return tab, synthesize(tab)
+
+    def _finish(self, i:int, tab:Tab, capture, times:dict, results):
+        '''Analyze and persist one point. Runs on the analysis thread.'''
+        result, times['analyze'] = self._timed(self.analyze, self.grid[i], tab, capture)
+        entry = dict(index=i, params=self.grid[i], result=result, timing=times)
+        if self.store is not None:
+            entry['capture'] = [self.store.save(c, sweep_index=i, params=self.grid[i]) for c in (capture if isinstance(capture, list) else [capture])]
+        results.write(json.dumps(pack(entry)) + '\n')
+        results.flush()
+        os.fsync(results.fileno())
+        for stage in STAGES:
+            self.timing[stage].append(times[stage])
+        return entry
+
+    def run(self)->list[dict]:
+        '''Run the points not finished yet. Returns the result lines of all points, in grid order.'''
+        finished = self.done()
+        todo = [i for i in range(len(self.grid)) if i not in finished]
+        if os.path.exists(self._path('results.jsonl')) and os.path.getsize(self._path('results.jsonl')) > 0:
+            with open(self._path('results.jsonl'), 'rb+') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n': # end a line torn by a crash, so the next result starts on its own line
+                    f.write(b'\n')
+        t_start = time.perf_counter()
+        with ThreadPoolExecutor(1) as synth, ThreadPoolExecutor(1) as instr, ThreadPoolExecutor(1) as ana, \
+             open(self._path('results.jsonl'), 'a') as results:
+            synthesized = synth.submit(self._timed, self._synthesize, todo[0]) if todo else None
+            analyzing = None
+            for k, i in enumerate(todo):
+                (tab, waveforms), t_synth = synthesized.result()
+                synthesized = synth.submit(self._timed, self._synthesize, todo[k+1]) if k+1 < len(todo) else None
+                acquiring = instr.submit(self._timed, self.acquire, self.grid[i], tab, waveforms)
+                if analyzing is not None:
+                    self._report(analyzing.result(), finished)
+                capture, t_acq = acquiring.result()
+                del waveforms
+                analyzing = ana.submit(self._finish, i, tab, capture, dict(synthesize=t_synth, acquire=t_acq), results)
+            if analyzing is not None:
+                self._report(analyzing.result(), finished)
+        self.wall_time = time.perf_counter() - t_start
+        return [finished[i] for i in sorted(finished)]
+
+    def _report(self, entry:dict, finished:dict):
+        finished[entry['index']] = entry
+        if self.progress is not None:
+            self.progress(len(finished), len(self.grid), entry)
+
+    def timing_report(self)->str:
+        '''Mean time per stage over the points run by this process, against the wall time per point.
+        The instrument-bound minimum is the acquire time: synthesis and analysis should hide behind it.'''
+        n = len(self.timing['acquire'])
+        if n == 0:
+            return 'No points run'
+        lines = [f'{"stage":<12} {"mean (ms)":>10} {"total (s)":>10}']
+        for stage in STAGES:
+            lines.append(f'{stage:<12} {np.mean(self.timing[stage])*1e3:>10.1f} {np.sum(self.timing[stage]):>10.2f}')
+        lines.append(f'{"wall":<12} {self.wall_time/n*1e3:>10.1f} {self.wall_time:>10.2f}')
+        return '\n'.join(lines)
+
+
+def instrument_acquire(awg, scopes:list, full_scale:float, timeout:float=3, bits:int=12):
+    '''An acquire stage for Sweep: stream each channel's waveform to the AWG (DG2000.send_arb), then trigger and
+    read every scope in parallel (acquisition.acquire). The capture is the list of get_data results, one per scope.'''
+    import DG2000, acquisition
+    def acquire(point:dict, tab:Tab, waveforms:dict[int,np.ndarray]):
+        if awg is not None:
+            with acquisition.instrument_lock(awg):
+                for channel, v in waveforms.items():
+                    DG2000.send_arb(awg, channel, [v], full_scale)
+        return acquisition.acquire(scopes, timeout=timeout, bits=bits)
+    return acquire
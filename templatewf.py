@@ -1,5 +1,160 @@
+import hashlib
+from fractions import Fraction
 import numpy as np
-from app_base import TemplateWF, _BaseParent
+from app_base import TemplateWF, _BaseParent, cached_sampling, cached_selector, to_dac_codes
+
+
+def _first_sample_at(t:float, dt:float, n_samples:int)->int:
+    '''Index of the first sample i (of n_samples) whose time i*dt is >= t'''
+    i = max(int(np.ceil(t/dt)), 0)
+    while i > 0 and (i-1)*dt >= t: # t/dt and i*dt round differently, step until i*dt agrees
+        i -= 1
+    while i*dt < t:
+        i += 1
+    return min(i, n_samples)
+
+def sample_piecewise_linear(t_knots:np.ndarray, v_knots:np.ndarray, sample_rate:float, n_samples:int, out:np.ndarray|None=None, start:int=0)->np.ndarray:
+    '''Sample the piecewise-linear curve through (t_knots, v_knots) at times i/sample_rate for start <= i < start+n_samples.
+    Gives the same bits as np.interp(np.arange(start, start+n_samples)*(1/sample_rate), t_knots, v_knots), but each ramp and flat segment
+    is written straight into a single output buffer, so the only temporary is one segment long.'''
+    dt = 1/sample_rate
+    stop = start + n_samples
+    if out is None:
+        out = np.empty(n_samples)
+    first = lambda t: min(max(_first_sample_at(t, dt, stop), start), stop) - start # local index in out
+    out[:first(t_knots[0])] = v_knots[0]
+    # only the segments that overlap this range, so rendering a long train in chunks does not rescan every knot
+    j0 = max(int(np.searchsorted(t_knots, start*dt, 'right'))-1, 0)
+    j1 = min(int(np.searchsorted(t_knots, stop*dt, 'left'))+1, len(t_knots)-1)
+    for j in range(j0, j1):
+        i0 = first(t_knots[j])
+        i1 = first(t_knots[j+1])
+        if i1 <= i0:
+            continue
+        seg = out[i0:i1]
+        if v_knots[j+1] == v_knots[j]:
+            seg.fill(v_knots[j])
+        else: # same arithmetic as np.interp: slope*(t - t_j) + v_j
+            slope = (v_knots[j+1] - v_knots[j])/(t_knots[j+1] - t_knots[j])
+            np.multiply(np.arange(start+i0, start+i1, dtype=float), dt, out=seg)
+            seg -= t_knots[j]
+            seg *= slope
+            seg += v_knots[j]
+    out[first(t_knots[-1]):] = v_knots[-1]
+    return out
+
+
+def _arange_len(stop:float, step:float)->int:
+    '''len(np.arange(0, stop, step)), without building the array'''
+    return max(int(np.ceil(stop/step)), 0)
+
+def rational_ratio(rate_out:float, rate_in:float, max_up:int=1024)->tuple[int,int]|None:
+    '''(up, down) with rate_out/rate_in == up/down to double precision, or None if that needs up > max_up'''
+    ratio = Fraction(rate_out/rate_in).limit_denominator(max_up)
+    if ratio.numerator > max_up or abs(float(ratio)*rate_in - rate_out) > 1e-12*rate_out:
+        return None
+    return ratio.numerator, ratio.denominator
+
+_polyphase_filters:dict[tuple,np.ndarray] = {}
+def polyphase_filter(up:int, down:int, half_width:int=16, beta:float=8.)->np.ndarray:
+    '''Kaiser-windowed sinc low-pass for resampling by up/down, split into its up phases: shape (up+1, taps).
+    h[p, i] weighs input sample q-i+taps//2 for an output that falls p/up of the way past input sample q.
+    The extra last phase (p = up, a whole sample on) lets resample_fractional interpolate between neighbouring phases.
+    The cut-off is the lower of the two Nyquist frequencies, and every phase is normalised to unit DC gain.'''
+    key = (up, down, half_width, beta)
+    if key not in _polyphase_filters:
+        width = max(up, down) # upsampled samples per cut-off period
+        half = (half_width*width + up - 1)//up # input samples on each side of an output
+        i = np.arange(-half, half+1) # taps, oldest input sample last
+        t = (np.arange(up+1)[:,None] + i[None,:]*up)/width # (phase, tap) distance from the output, in cut-off periods
+        h = np.sinc(t)*np.i0(beta*np.sqrt(np.clip(1 - (t/half_width)**2, 0, None)))/np.i0(beta)
+        h[np.abs(t) > half_width] = 0
+        _polyphase_filters[key] = h/h.sum(axis=1, keepdims=True)
+    return _polyphase_filters[key]
+
+def resample_poly(x:np.ndarray, up:int, down:int, n_samples:int, out:np.ndarray|None=None, start:int=0,
+                  chunk:int=2**18, **filter_kwargs)->np.ndarray:
+    '''Samples start ... start+n_samples of x resampled by the rational factor up/down, where output sample m sits at
+    input position m*down/up. Outputs m, m+up, m+2*up ... share a filter phase and read input down samples apart,
+    so each phase is a single matrix-vector product over a strided view of the input.
+    Works chunk outputs at a time, so temporaries stay small and any window of a long waveform can be rendered on its own.
+    The signal is extended by repeating its end samples.'''
+    h = polyphase_filter(up, down, **filter_kwargs)[:, ::-1] # taps in the order of increasing input index
+    taps = h.shape[1]
+    half = taps//2
+    if out is None:
+        out = np.empty(n_samples)
+    for c in range(0, n_samples, chunk):
+        m0, m1 = start+c, start+min(c+chunk, n_samples)
+        lo = (m0*down)//up - half # first input sample this chunk reads
+        xw = x[np.clip(np.arange(lo, (m1*down)//up + half + 1), 0, len(x)-1)] # the window it reads, edges repeated
+        seg = out[c:c+m1-m0]
+        for r in range(min(up, m1-m0)):
+            q, p = divmod((m0+r)*down, up)
+            rows = np.lib.stride_tricks.as_strided(xw[q-half-lo:], shape=(len(seg[r::up]), taps), strides=(down*xw.strides[0], xw.strides[0]),
+                                                   writeable=False)
+            seg[r::up] = rows @ h[p]
+    return out
+
+def resample_fractional(x:np.ndarray, step:float, n_samples:int, out:np.ndarray|None=None, start:int=0,
+                        chunk:int=2**14, phases:int=1024, **filter_kwargs)->np.ndarray:
+    '''Like resample_poly, but output sample m sits at input position m*step for any step, e.g. an irrational rate ratio.
+    The filter is looked up in a table of the given number of phases per input sample, interpolating linearly between them.'''
+    h = polyphase_filter(phases, max(int(round(phases*step)), 1), **filter_kwargs)[:, ::-1] # increasing input index
+    dh = np.diff(h, axis=0) # change to the next phase
+    taps = h.shape[1]
+    half = taps//2
+    if out is None:
+        out = np.empty(n_samples)
+    for c in range(0, n_samples, chunk):
+        pos = np.arange(start+c, start+min(c+chunk, n_samples))*step
+        q = np.floor(pos)
+        f = (pos - q)*phases
+        p = np.minimum(f.astype(int), phases-1)
+        w = (f - p)[:,None] # weight of the next phase
+        lo = int(q[0]) - half
+        xw = x[np.clip(np.arange(lo, int(q[-1]) + half + 1), 0, len(x)-1)] # the window this chunk reads, edges repeated
+        rows = xw[(q.astype(int) - half - lo)[:,None] + np.arange(taps)]
+        coef = h[p] + w*dh[p]
+        np.einsum('ij,ij->i', rows, coef, out=out[c:c+len(pos)])
+    return out
+
+def resample_fft(x:np.ndarray, n_samples:int)->np.ndarray:
+    '''x resampled to n_samples by truncating or zero-padding its spectrum. Works for any ratio and is exact for
+    band-limited periodic signals, but treats x as one period (a jump between its ends rings through the whole output)
+    and needs all of it in memory.'''
+    X = np.fft.rfft(x)
+    n_bins = n_samples//2 + 1
+    Y = np.zeros(n_bins, dtype=complex)
+    n = min(n_bins, len(X))
+    Y[:n] = X[:n]
+    if n_samples < len(x) and n_samples % 2 == 0: # the new Nyquist bin holds both of its folded halves
+        Y[-1] = Y[-1].real
+    return np.fft.irfft(Y, n_samples)*(n_samples/len(x))
+
+def decimate_minmax(t:np.ndarray, v:np.ndarray, n_bins:int, t_start:float|None=None, t_stop:float|None=None)->tuple[np.ndarray, np.ndarray]:
+    '''Reduce a time-sorted trace to what is visible between t_start and t_stop at a resolution of n_bins.
+    The points just outside the window are kept so lines run to the edges. If more than 2*n_bins points remain,
+    each bin keeps only its min and max (in time order) plus the two end points, which draws the same picture.'''
+    if len(t) == 0:
+        return t, v
+    t_start = t[0] if t_start is None else t_start
+    t_stop = t[-1] if t_stop is None else t_stop
+    i0 = max(int(np.searchsorted(t, t_start, 'right'))-1, 0)
+    i1 = min(int(np.searchsorted(t, t_stop, 'left'))+1, len(t))
+    t, v = t[i0:i1], v[i0:i1]
+    if len(t) <= 2*n_bins:
+        return t, v
+    starts = np.searchsorted(t, np.linspace(t[0], t[-1], n_bins+1)[:-1])
+    starts = np.unique(starts[starts < len(t)]) # first index of each non-empty bin
+    bin_of = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(t))))
+    keep = [[0, len(t)-1]]
+    for extreme in (np.minimum.reduceat(v, starts), np.maximum.reduceat(v, starts)):
+        hits = np.flatnonzero(v == extreme[bin_of])
+        _, first = np.unique(bin_of[hits], return_index=True) # first occurrence of the extreme in each bin
+        keep.append(hits[first])
+    idx = np.unique(np.concatenate(keep))
+    return t[idx], v[idx]
 
 
 class CollectionTemplateWF(_BaseParent, TemplateWF):
@@ -11,31 +166,69 @@ class CollectionTemplateWF(_BaseParent, TemplateWF):
         for block in blocks:
             self.add_child(child=block)
     def get_skeleton(self):
-        t = [0]
+        t = []
         v = []
+        t_end = 0
         for i,block in enumerate(self._children):
             t_,v_ = block.get_skeleton()
             if i>0: # exclude first point for subsequent blocks
                 t_ = t_[1:]
                 v_ = v_[1:]
-            t.extend( (t_+t[-1]).tolist() )
-            v.extend( v_.tolist() )
-        return np.array(t[1:]), np.array(v)
+            t.append( t_+t_end )
+            v.append( v_ )
+            if len(t_) > 0:
+                t_end = t[-1][-1]
+        if len(t) == 0:
+            return np.array([]), np.array([])
+        return np.concatenate(t), np.concatenate(v)
+    def get_preview(self, n_bins:int, t_start:float|None=None, t_stop:float|None=None)->tuple[np.ndarray, np.ndarray]:
+        '''Skeleton reduced to what can be seen between t_start and t_stop on a plot n_bins pixels wide'''
+        return decimate_minmax(*self.get_skeleton(), n_bins, t_start, t_stop)
+    def n_samples(self, sample_rate:float)->int:
+        return sum(block.n_samples(sample_rate) for block in self._children)
+    def duration(self)->float:
+        '''Length of the whole waveform in seconds'''
+        t, _ = self.get_skeleton()
+        return float(t[-1]) if len(t) > 0 else 0.
     def get_time_array(self, sample_rate:float):
-        total_len = np.sum([len(block.get_time_array()) for block in self.blocks])
-        return np.arange(0, total_len/sample_rate, 1/sample_rate)
-    def sample(self, sample_rate:float):
-        return np.concat( [block.sample_wf(sample_rate) for block in self.blocks] )
+        return np.arange(self.n_samples(sample_rate))*(1/sample_rate)
+    def sample_into(self, out:np.ndarray, sample_rate:float, start:int=0):
+        '''Each block overlapping samples start ... start+len(out) renders into its own slice of out'''
+        offset = 0 # index of the current block's first sample in the whole collection
+        stop = start + len(out)
+        for block in self._children:
+            n = block.n_samples(sample_rate)
+            lo, hi = max(start, offset), min(stop, offset+n)
+            if lo < hi:
+                block.sample_into(out[lo-start:hi-start], sample_rate, start=lo-offset)
+            offset += n
+            if offset >= stop:
+                break
+    def sample_wf(self, sample_rate:float, dtype:np.dtype=float, full_scale:float|None=None,
+                  code_range:tuple[int,int]|None=None)->np.ndarray:
+        '''Sample all blocks into one preallocated array of the given dtype.
+        Integer dtypes give DAC codes, with -full_scale ... +full_scale volts mapped onto code_range, see to_dac_codes.
+        E.g. sample_wf(rate, np.uint16, full_scale, DG2000.DAC_RANGE) gives the codes DG2000.send_arb uploads.'''
+        out = np.empty(self.n_samples(sample_rate), dtype=dtype)
+        if np.issubdtype(out.dtype, np.floating):
+            self.sample_into(out, sample_rate)
+            return out
+        assert full_scale is not None, f'full_scale must be given to sample into integer dtype {out.dtype}'
+        start = 0
+        for chunk in self.iter_chunks(sample_rate): # render through one reused float buffer, never a whole block in float
+            to_dac_codes(chunk, full_scale, out=out[start:start+len(chunk)], code_range=code_range)
+            start += len(chunk)
+        return out
     def add_child(self, child:TemplateWF):
         assert isinstance(child, TemplateWF), f'Expected a child instance of TemplateWF, but got {type(child)}!'
         super().add_child(child)
     def get_ROIs(self, sample_rate:float, offset:float=0, lblfmt:str='{prefix}.{childIdx}.{suffix}')->dict[str,slice]:
         d = dict()
         for i,block in enumerate(self._children):
-            d.update(block.get_ROIs(sample_rate, offset, lblfmt.format(childIdx=i)))
-            offset += block.get_time_array()[-1]
+            d.update(block.get_ROIs(sample_rate, offset, lblfmt.replace('{childIdx}', str(i)))) # leave {prefix} and {suffix} for the block
+            offset += block.n_samples(sample_rate)/sample_rate
         return d
-    @property
+    @cached_selector
     def selector(self):
         return (self.parent.selector + ' ' if self.parent is not None else '') + f'[data-pyclassname="{self.__class__.__name__}"]'
 
@@ -73,25 +266,22 @@ class PUNDTemplateWF(TemplateWF):
             else:
                 break
         return np.array(t),np.array(v)
+    @cached_sampling
     def get_time_array(self, sample_rate):
-        return np.arange(0, self.n_cycles*(4*self.delay_time + 8*self.delay_time), 1/sample_rate)
-    def sample_wf(self, sample_rate:float):
-        time = self.get_time_array(sample_rate)
-        quarter_PUND = lambda t, rise_time, period, quarter: np.abs((2 * (
-                                                                    (t-period/4*quarter - period * np.floor((t-period/4*quarter) / (rise_time + period))) / rise_time -
-                                                                    np.floor((t-period/4*quarter - period * np.floor((t-period/4*quarter) / (rise_time + period))) / rise_time + 0.5)))
-                                                                ) * ((t-period/4*quarter) % (rise_time + period) < rise_time)
-        pund = lambda t, rise_time, delay_time: + quarter_PUND(t, rise_time, rise_time*8+delay_time*4, 0) \
-                                                + quarter_PUND(t, rise_time, rise_time*8+delay_time*4, 1) \
-                                                - quarter_PUND(t, rise_time, rise_time*8+delay_time*4, 2) \
-                                                - quarter_PUND(t, rise_time, rise_time*8+delay_time*4, 3)
-        return self.offset + self.amplitude*pund(time, self.rise_time, self.delay_time)
+        return np.arange(0, self.n_cycles*(4*self.delay_time + 8*self.rise_time), 1/sample_rate)
+    def n_samples(self, sample_rate):
+        return _arange_len(self.n_cycles*(4*self.delay_time + 8*self.rise_time), 1/sample_rate)
+    def period(self):
+        return 4*self.delay_time + 8*self.rise_time
+    def _render_into(self, out, sample_rate, start=0):
+        sample_piecewise_linear(*self.get_skeleton(), sample_rate, len(out), out=out, start=start)
     def get_ROIs(self, sample_rate:float, offset:float=0, lblfmt:str='{prefix}.{suffix}')->dict[str,slice]:
+        '''Slices of each pulse (rise and fall) at this sample rate, for a block that starts offset seconds into the waveform.
+        Every pulse slice has the same length, so they can be stacked.'''
         d = dict()
         T = 4*self.delay_time + 8*self.rise_time # wf period
-        length = self.n_cycles*T/sample_rate # array length at this sampling rate
-        pulse_len = 2*self.rise_time/sample_rate # array length of a pulse
-        start = offset/sample_rate # starting idx
+        duration = self.n_cycles*T # block duration
+        pulse_len = int(round(2*self.rise_time*sample_rate)) # array length of a pulse
 
         if self.amplitude > 0: # if labels will be drawn from PUND or NDPU string
             pre = 'PUND'
@@ -102,11 +292,11 @@ class PUNDTemplateWF(TemplateWF):
 
         for n in np.arange(self.n_cycles):
             for p in range(4):
-                stop  = start + pulse_len # stopping idx
-                if stop > length:
+                t0 = n*T + p*(2*self.rise_time + self.delay_time) # pulse start, relative to the block
+                if t0 + 2*self.rise_time > duration*(1 + 1e-12): # pulse cut off by the end of the block
                     break
-                d[lblfmt.format(prefix=pre[p], suffix=int(n))] = slice(int(start), int(stop))
-                start += (2*self.rise_time + self.delay_time)/sample_rate
+                start = int(round((offset + t0)*sample_rate)) # starting idx
+                d[lblfmt.format(prefix=pre[p], suffix=int(n))] = slice(start, start+pulse_len)
         return d
 
 
@@ -131,10 +321,21 @@ class SineTemplateWF(TemplateWF):
     def get_skeleton(self):
         sample_rate = self.freq*50 # be well above nyquist. 50 datapoints per cycle.
         return self.get_time_array(sample_rate), self.sample_wf(sample_rate)
+    @cached_sampling
     def get_time_array(self, sample_rate):
         return np.arange(0, self.n_cycles/self.freq+1/sample_rate, 1/sample_rate)
-    def sample_wf(self, sample_rate):
-        return self.amplitude * np.sin(2*np.pi*self.freq*self.get_time_array(sample_rate) - self.phase) + self.offset
+    def n_samples(self, sample_rate):
+        return _arange_len(self.n_cycles/self.freq+1/sample_rate, 1/sample_rate)
+    def period(self):
+        return 1/self.freq
+    def _render_into(self, out, sample_rate, start=0):
+        # amplitude * sin(2 pi f t - phase) + offset, one operation at a time in place. Times are built the same way np.arange does.
+        np.multiply(np.arange(start, start+len(out), dtype=float), 1/sample_rate, out=out)
+        out *= 2*np.pi*self.freq
+        out -= self.phase
+        np.sin(out, out=out)
+        out *= self.amplitude
+        out += self.offset
 
 
 class ConstantTemplateWF(TemplateWF):
@@ -151,14 +352,19 @@ class ConstantTemplateWF(TemplateWF):
         self.duration= duration
     def get_skeleton(self):
         return np.array([0, self.duration]), np.array([self.value]*2)
+    @cached_sampling
     def get_time_array(self, sample_rate):
         return np.arange(0, self.duration, 1/sample_rate)
-    def sample_wf(self, sample_rate):
-        return self.value * np.ones(len(self.get_time_array(sample_rate)))
+    def n_samples(self, sample_rate):
+        return _arange_len(self.duration, 1/sample_rate)
+    def _render_into(self, out, sample_rate, start=0):
+        out.fill(self.value)
 
 
 class ArbitraryTemplateWF(TemplateWF):
     '''Block for holding arbitrary waveforms, more than just those predefined here.'''
+    max_polyphase_up = 1024 # rate ratios that need a larger numerator are resampled with resample_fractional
+    resample_method = 'polyphase' # or 'fft', for waveforms that are exactly one period of a periodic signal
     def to_dict(self):
         res = super().to_dict()
         res.update( values=self.values,
@@ -166,17 +372,58 @@ class ArbitraryTemplateWF(TemplateWF):
         return res
     def __init__(self, values:np.ndarray=[], init_sample_rate:float=1):
         super().__init__()
-        self.values = np.array(values)
+        self.values = values
         self.init_sample_rate = init_sample_rate
+    @property
+    def values(self)->np.ndarray:
+        return self._values
+    @values.setter
+    def values(self, values:np.ndarray):
+        values = np.asarray(values)
+        if values.flags.writeable: # keep a private read-only copy, so the samples can only change through this setter
+            values = values.copy()
+            values.flags.writeable = False
+        self._values = values
+        self._values_digest = None # recomputed lazily by _cache_key
+    def _cache_key(self)->tuple:
+        # hashing the raw samples once is much cheaper than putting millions of floats in a tuple
+        if self._values_digest is None:
+            self._values_digest = hashlib.blake2b(np.ascontiguousarray(self._values).data, digest_size=16).hexdigest()
+        return (self.__class__, (('values', self._values_digest), ('init_sample_rate', self.init_sample_rate)))
     def get_skeleton(self):
         return self.get_time_array(self.init_sample_rate), self.sample_wf(self.init_sample_rate)
+    @cached_sampling
     def get_time_array(self, sample_rate):
-        return np.arange(0, len(self.values)/self.init_sample_rate, 1/sample_rate)
+        return np.arange(self.n_samples(sample_rate))*(1/sample_rate)
+    def n_samples(self, sample_rate):
+        if sample_rate == self.init_sample_rate: # exactly one sample per value, whatever floating point makes of len/rate
+            return len(self.values)
+        return _arange_len(len(self.values)/self.init_sample_rate, 1/sample_rate)
+    @cached_sampling
     def sample_wf(self, sample_rate:float):
+        '''The values at init_sample_rate, otherwise band-limited resampling (see _render_into), cached per rate'''
         if sample_rate == self.init_sample_rate:
             return self.values
+        out = np.empty(self.n_samples(sample_rate))
+        self._render_into(out, sample_rate)
+        return out
+    def _render_into(self, out, sample_rate, start=0):
+        '''Polyphase resampling, with an exact rational ratio if the rates have a small one. Works on any window of the output.
+        With resample_method 'fft' the whole waveform is resampled through the FFT instead, once, and cached.'''
+        if sample_rate == self.init_sample_rate:
+            out[...] = self.values[start:start+len(out)]
+            return
+        if self.resample_method == 'fft':
+            if start == 0 and len(out) == self.n_samples(sample_rate):
+                out[...] = resample_fft(self.values, len(out))
+            else:
+                out[...] = self.sample_wf(sample_rate)[start:start+len(out)]
+            return
+        ratio = rational_ratio(sample_rate, self.init_sample_rate, self.max_polyphase_up)
+        if ratio is not None:
+            resample_poly(self.values, *ratio, len(out), out=out, start=start)
         else:
-            raise NotImplementedError('Interpolation of arbitrary waveforms not yet supported')
+            resample_fractional(self.values, self.init_sample_rate/sample_rate, len(out), out=out, start=start)
 
 
 
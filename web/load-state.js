@@ -16,11 +16,18 @@ $(document).ready(async function() {
         });
     });
 
-    let rsrcs = await eel.py_get_available_resources()();
-    for (let index = 0; index < rsrcs.length; index++) {
-        $('#available-resources').append(`<option>${rsrcs[index]}</option>`)
-    }
+    // Resources found last time are listed straight away, then refreshed in the background
+    show_resources(await eel.py_get_available_resources()());
+    const status = await run_job(eel.py_refresh_resources()());
+    if (status.state == 'done') {show_resources(status.result);}
 
 
 });
 
+
+function show_resources(rsrcs) {
+    $('#available-resources').empty();
+    for (let index = 0; index < rsrcs.length; index++) {
+        $('#available-resources').append(`<option>${rsrcs[index]}</option>`)
+    }
+}
@@ -30,12 +30,27 @@ $(document).ready(function() {
 
     // Connect to instruments
     $('#connect-btn').click(function() {
-        eel.py_connect();
+        run_job(eel.py_connect()());
     });
     
+    // Connect to one instrument from the connections tab
+    $('#connect-awg-btn').click(function() {
+        connect_instrument('awg', $('#awg-ip').val(), $(this));
+    });
+    $('#connect-oscilloscope-btn').click(function() {
+        connect_instrument('oscilloscope', $('#oscilloscope-ip').val(), $(this));
+    });
+
     // Trigger Instruments
     $('#trigger-btn').click(function() {
-        eel.py_trigger();
+        run_job(eel.py_trigger()());
+    });
+
+    // Cancel every running background job
+    $('#cancel-job-btn').click(function() {
+        for (const job_id of Object.keys(pending_jobs)) {
+            eel.py_cancel_job(Number(job_id));
+        }
     });
 
     // Close a popup waveform editor
@@ -78,3 +93,54 @@ function js_update_frontend(element_selector, params) {
     };
     // console.log(element_selector, $elem.data('py_id'), params)
 }
+
+eel.expose(js_update_frontend_batch);
+function js_update_frontend_batch(diffs) {
+    // diffs is a list of [selector, params] for a whole subtree, containing only what changed.
+    // Resolve every selector first, then write, so the DOM is walked once for the batch.
+    const targets = diffs.map(([selector, params]) => [$(selector), params]);
+    for (const [$elem, params] of targets) {
+        for (const [key, value] of Object.entries(params)) {
+            $elem.data(key, value);
+        }
+    }
+}
+
+// Background jobs. Long python operations return a job id right away and report through js_job_progress.
+const pending_jobs = {}; // job_id -> {resolve, updates}, for jobs whose final status has not arrived yet
+const early_updates = {}; // job_id -> last status, for updates that arrive before run_job has registered the job
+
+async function run_job(job_id_promise, on_progress) {
+    // Resolves with the job's final status, {job_id, name, state, progress, message, result, error}
+    const job_id = await job_id_promise;
+    return new Promise(resolve => {
+        pending_jobs[job_id] = {resolve: resolve, on_progress: on_progress};
+        if (job_id in early_updates) {
+            const status = early_updates[job_id];
+            delete early_updates[job_id];
+            js_job_progress(status);
+        }
+    });
+}
+
+eel.expose(js_job_progress);
+function js_job_progress(status) {
+    const job = pending_jobs[status.job_id];
+    if (job === undefined) {
+        early_updates[status.job_id] = status;
+        return;
+    }
+    $('#job-status').text(`${status.name}: ${status.state} ${Math.round(100*status.progress)}% ${status.message}`);
+    if (job.on_progress) {job.on_progress(status);}
+    if (['done', 'failed', 'cancelled'].includes(status.state)) {
+        if (status.error) {console.error(status.name, status.error);}
+        delete pending_jobs[status.job_id];
+        job.resolve(status);
+    }
+}
+
+async function connect_instrument(role, resource_name, $btn) {
+    const status = await run_job(eel.py_connect({[role]: resource_name})());
+    $btn.toggleClass('btn-success', status.state == 'done');
+    $btn.attr('title', status.state == 'done' ? status.result[role] : status.error);
+}
@@ -148,8 +148,8 @@ $(document).ready(function() {
     // Upload waveform
     $('#tab-content').on('click', '.configure-devices', async function() {
         const tabId = get_enclosing_tab_id($(this));
-        let success = await eel.py_send_waveform(tabId)();
-        if (success) { // Apply some styles to the tab that has been sent
+        const status = await run_job(eel.py_send_waveform(tabId)());
+        if (status.state == 'done' && status.result) { // Apply some styles to the tab that has been sent
             $('.configure-devices').removeClass('btn-success')
             $(this).addClass('btn-success')
 
@@ -166,6 +166,11 @@ $(document).ready(function() {
         console.log('Old value', $(this).closest(`[data-pyclassname]`).data(param_name));
         $(this).closest(`[data-pyclassname]`).data(param_name, new_param_value);
         console.log('Check new value took hold:', $(this).closest(`[data-pyclassname]`).data(param_name));
+        // the DOM no longer shows what the backend last sent, so the next py_update_frontend must resend this element
+        const py_id = $(this).closest(`[data-pyclassname]`).data('py_id');
+        if (py_id !== undefined) {
+            eel.py_forget_sent_params(py_id);
+        }
     });
 
 });
@@ -174,8 +179,26 @@ function get_enclosing_tab_id($elem) {
     return $elem.closest('.tab-pane').attr('id');
 };
 
+function decode_float32(b64, offset=0) {
+    // base64 little-endian float32 buffer -> plain array, with offset added back on
+    const bytes = Uint8Array.from(atob(b64), c => c.charCodeAt(0));
+    return Array.from(new Float32Array(bytes.buffer), x => x + offset);
+}
+
+async function get_wf_preview($awgsettings, width, xrange=[null, null]) {
+    const traces = await eel.py_get_wf_preview($awgsettings.data('py_id'), width, xrange[0], xrange[1])();
+    return traces.map(trace => ({
+        x: decode_float32(trace.x, trace.x0),
+        y: decode_float32(trace.y),
+        type: 'scatter',
+        name: trace.name
+    })); //plotly structure
+}
+
 async function refresh_wf_preview($awgsettings) {
-    let data = await eel.py_get_wf_skeleton($awgsettings.data('py_id'))();
+    const plotDiv = $awgsettings.parent().find('.plot-container')[0];
+    const width = Math.max(plotDiv.clientWidth, 100);
+    let data = await get_wf_preview($awgsettings, width);
 
     let layout = {
         title: {
@@ -218,7 +241,22 @@ async function refresh_wf_preview($awgsettings) {
     let config = {
         responsive: true
     }
-    Plotly.newPlot($awgsettings.parent().find('.plot-container')[0], data, layout, config);
+    await Plotly.newPlot(plotDiv, data, layout, config);
+
+    // When zooming or panning, fetch just the visible window at screen resolution
+    plotDiv.removeAllListeners('plotly_relayout');
+    plotDiv.on('plotly_relayout', async function(ev) {
+        let xrange;
+        if (ev['xaxis.range[0]'] !== undefined) {
+            xrange = [ev['xaxis.range[0]'], ev['xaxis.range[1]']];
+        } else if (ev['xaxis.autorange']) {
+            xrange = [null, null];
+        } else {
+            return;
+        }
+        const zoomed = await get_wf_preview($awgsettings, Math.max(plotDiv.clientWidth, 100), xrange);
+        Plotly.restyle(plotDiv, {x: zoomed.map(trace => trace.x), y: zoomed.map(trace => trace.y)});
+    });
 };
 
 function add_wf_block($wrapper, new_py_id, wfType) {